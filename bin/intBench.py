@@ -0,0 +1,55 @@
+# Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
+#                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os, sys
+thisDir = os.path.dirname(__file__)
+rootDir = os.path.dirname(thisDir)
+if rootDir not in sys.path:
+    sys.path.append(rootDir)
+
+import argparse
+import contextlib
+import io
+import time
+
+from bootstrap.parser import Token
+from bootstrap.interpreter import buildPidginParser, Execution, ProgramBuilder
+
+# Time the interpreter on a counting loop. The program is parsed, translated and compiled before the clock
+# starts, so that the numbers are for execution alone: run() is the compiled fast path and step() executes the
+# same closures one instruction at a time through the checks that support tracing.
+
+PROGRAM = 'a = 0\nd = 0\nwhile a<{n} {{\n    a = a+1\n    d = d+a\n}}\nprint!d'
+
+
+def prepare(parser, n):
+    source = 'func main:int [stdin:string] {' + PROGRAM.format(n=n) + '\nreturn 0}'
+    tree = next(parser.execute(source))
+    builder = ProgramBuilder(tree if isinstance(tree, Token) else (tree,))
+    builder.typeEnv.wipe()
+    return Execution(builder.outermost, builder.typeEnv)
+
+
+def measure(parser, n, stepped):
+    execution = prepare(parser, n)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stepped:
+            while execution.step():
+                pass
+        else:
+            execution.run()
+    return time.perf_counter() - started
+
+
+if __name__=='__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('-n', '--iterations', type=int, default=100000, help='Trips around the loop')
+    argParser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of each mode, the best is reported')
+    args = argParser.parse_args()
+
+    parser = buildPidginParser(start='program')
+    best = {}
+    for stepped in (True, False):
+        best[stepped] = min( measure(parser, args.iterations, stepped) for _ in range(args.repeat) )
+    print(f'step: {best[True]:.3f}s  run: {best[False]:.3f}s  speedup: {best[True]/best[False]:.1f}x '
+          f'over {args.iterations} iterations')
@@ -14,7 +14,7 @@ import traceback
 
 from bootstrap.grammar import Grammar
 from bootstrap.machine import Automaton
-from bootstrap.parser import Parser
+from bootstrap.parser import Parser, TokenCache
 
 GRAY = "\033[0;37m"
 RED = "\033[1;31m"
@@ -56,6 +56,10 @@ argParser.add_argument("-f","--filter")
 argParser.add_argument("-p","--positive", type=int, default=-1)
 argParser.add_argument("-n","--negative", type=int, default=-1)
 argParser.add_argument("-s","--showtrees", action="store_true")
+argParser.add_argument("-r","--redundancy", action="store_true")
+argParser.add_argument("-l","--nolatch", action="store_true")
+argParser.add_argument("-P","--noprune", action="store_true")
+argParser.add_argument("-c","--cache", type=int, help="capacity of the token cache shared between stacks")
 args = argParser.parse_args()
 passed, failed = 0, 0
 sys.setrecursionlimit(5000)
@@ -102,10 +106,18 @@ for d in subDirs:
             largePositives[unitName].append(os.path.join(u,e.name))
 
 
+redundancy = {}
+cache = None if args.cache is None else TokenCache(args.cache)
+def recordTrace(parser, name):
+    if not name in redundancy:
+        redundancy[name] = []
+    redundancy[name].append( (parser.trace.measure(),) + parser.trace.size() )
+
 def testPositive(parser, input, dir, name, caseName, snippet):
     global passed, failed
     results = [r for r in parser.execute(input, True)]
     parser.trace.output( open(os.path.join(dir,f'{caseName}.dot'),'wt') )
+    recordTrace(parser, name)
     if len(results)==0:
         print(f'{RED}Failed on {name} {caseName} {snippet}{END}')
         failed += 1
@@ -144,7 +156,7 @@ for (u,addToDoc) in units:
         os.makedirs(dir, exist_ok=True)
         automaton = Automaton(grammar)
         automaton.dot( open(os.path.join(dir,"eclr.dot"), "wt") )
-        parser = Parser(automaton)
+        parser = Parser(automaton, latching=not args.nolatch, pruning=not args.noprune, cache=cache)
 
         for i,p in enumerate(positive):
             if args.negative!=-1: continue
@@ -165,6 +177,7 @@ for (u,addToDoc) in units:
             if args.verbose: print(f'{GRAY}Executing n{i} on {name}: {n}')
             results = [r for r in parser.execute(n, True)]
             parser.trace.output( open(os.path.join(dir,f'n{i}.dot'),'wt') )
+            recordTrace(parser, name)
             if len(results)>0:
                 print(f'{RED}Failed on {name} negative {i} {n}{END}')
                 failed += 1
@@ -182,7 +195,9 @@ for (u,addToDoc) in units:
             if args.verbose: print(f'{GRAY}Executing a{i} on {name}: {a}')
             results = [r for r in parser.execute(a, True)]
             parser.trace.output( open(os.path.join(dir,f'a{i}.dot'),'wt') )
-            if len(results)<2:
+            recordTrace(parser, name)
+            # The cache commits to the first derivation of each span so ambiguity collapses to one tree
+            if len(results) < (1 if cache is not None else 2):
                 print(f'{RED}Failed on {name} ambiguous {i} {a}{END}')
                 failed += 1
             else:
@@ -197,5 +212,18 @@ for (u,addToDoc) in units:
         print(f"{RED}Failed to build case {u.__qualname__}{GRAY}")
         traceback.print_exc()
         print(END)
+if args.redundancy:
+    print(f'{"grammar":32} {"redundancy":>10} {"pstates":>8} {"barriers":>8}')
+    totalStates, totalBarriers = 0, 0
+    for name, traces in redundancy.items():
+        ratio    = sum(t[0] for t in traces) / len(traces)
+        states   = sum(t[1] for t in traces)
+        barriers = sum(t[2] for t in traces)
+        totalStates   += states
+        totalBarriers += barriers
+        print(f'{name:32} {ratio:10.3f} {states:8} {barriers:8}')
+    print(f'{"total":32} {"":10} {totalStates:8} {totalBarriers:8}')
+if cache is not None:
+    cache.report()
 print(f'{passed} passed / {failed} failed')
 
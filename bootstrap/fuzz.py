@@ -0,0 +1,127 @@
+# Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
+#                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os, sys
+rootDir= os.path.dirname(os.path.dirname(__file__))
+if rootDir not in sys.path:
+    sys.path.append(rootDir)
+
+import argparse
+import collections
+import itertools
+import random
+import time
+from bootstrap.generator import Generator
+from bootstrap.interpreter import buildCommon, stage2
+from bootstrap.machine import Automaton
+from bootstrap.parser import Parser, TokenCache
+from bootstrap.sampler import Sampler, renderText
+
+
+class FuzzReport:
+    '''Throughput and acceptance of the Parser over sentences generated from its own grammar. Every sentence
+       should be accepted, the ones that are not are kept in *rejected* with their size. The time to the first
+       tree and the time to exhaust every tree are recorded separately, as an ambiguous sentence keeps the
+       parser working after it has produced a result.'''
+    def __init__(self):
+        self.sentences = 0
+        self.bytes     = 0
+        self.first     = 0.0
+        self.seconds   = 0.0
+        self.peak      = 0
+        self.ambiguous = 0
+        self.rejected  = []
+        self.bySize    = collections.defaultdict(lambda: [0, 0, 0.0, 0.0, 0])   # sentences, bytes, first, all, peak
+
+    def add(self, size, text, trees, first, seconds, peak):
+        self.sentences += 1
+        self.bytes     += len(text)
+        self.first     += first
+        self.seconds   += seconds
+        self.peak       = max(self.peak, peak)
+        row = self.bySize[size]
+        row[0] += 1
+        row[1] += len(text)
+        row[2] += first
+        row[3] += seconds
+        row[4]  = max(row[4], peak)
+        if trees==0:
+            self.rejected.append((size, text))
+        elif trees>1:
+            self.ambiguous += 1
+
+    def report(self, file=sys.stdout):
+        bytes = max(self.bytes, 1)
+        print(f'{self.sentences} sentences, {self.bytes} bytes in {self.seconds:.3f}s: '
+              f'{1e6*self.first/bytes:.1f}us/byte to first tree, {1e6*self.seconds/bytes:.1f}us/byte to all, '
+              f'peak {self.peak} live states, {self.ambiguous} ambiguous, {len(self.rejected)} rejected', file=file)
+        for size, (sentences, bytes, first, seconds, peak) in sorted(self.bySize.items()):
+            print(f'  size {size}: {sentences} sentences, {1e6*first/max(bytes,1):.1f}us/byte first, '
+                  f'{1e6*seconds/max(bytes,1):.1f}us/byte all, peak {peak}', file=file)
+        for size, text in self.rejected:
+            print(f'  rejected (size {size}): {text!r}', file=file)
+
+
+def fuzz(parser, sentences, report=None):
+    '''Parse each (size,text) in *sentences* to exhaustion and record the outcome in the *report*.'''
+    report = FuzzReport() if report is None else report
+    for size, text in sentences:
+        start = time.perf_counter()
+        results = parser.execute(text)
+        trees = 0 if next(results, None) is None else 1
+        first = time.perf_counter() - start
+        trees += sum(1 for _ in results)
+        report.add(size, text, trees, first, time.perf_counter()-start, parser.peak)
+    return report
+
+
+def sampled(grammar, rule, sizes, count, seed=None):
+    '''Uniformly sampled sentences of each size, rendered as text.'''
+    sampler = Sampler(grammar, bottomup=True)
+    rng = random.Random(seed)
+    for size in sizes:
+        if sampler.count_rule(rule, size, [])==0:
+            continue
+        for terminals in sampler.sample_many(rule, size, count, seed=rng.randrange(2**32)):
+            yield size, renderText(terminals, rng)
+
+
+def generated(grammar, count, frontier=10000, seed=None):
+    '''The first *count* sentences from a bounded exploration of the grammar, shortest first.'''
+    rng = random.Random(seed)
+    for terminals in itertools.islice(Generator(grammar).explore(frontier), count):
+        yield len([t for t in terminals if t.isTerminal]), renderText(terminals, rng)
+
+
+if __name__=='__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("-g", "--grammar", type=str, default="bootstrap/interpreter/grammar.g")
+    argParser.add_argument("-r", "--rule", type=str, default="program")
+    argParser.add_argument("-s", "--sizes", type=str, default="1:20", help="range of sentence sizes as min:max")
+    argParser.add_argument("-n", "--number", type=int, default=20, help="sentences of each size")
+    argParser.add_argument("--seed", type=int)
+    argParser.add_argument("--generator", action='store_true', help="explore with the Generator instead")
+    argParser.add_argument("--cache", type=int, help="parse with a TokenCache of this capacity")
+    args = argParser.parse_args()
+
+    stage1g, _, stage1 = buildCommon()
+    res = next(stage1.execute(open(args.grammar).read()), None)
+    if res is None:
+        print(f"Failed to parse grammar from {args.grammar}")
+        sys.exit(-1)
+    grammar = stage2(res)
+    grammar.start = args.rule
+    if grammar.discard is None:
+        grammar.discard = stage1g.discard
+    cache = None if args.cache is None else TokenCache(args.cache)
+    parser = Parser(Automaton(grammar), cache=cache)
+
+    if args.generator:
+        sentences = generated(grammar, args.number, seed=args.seed)
+    else:
+        low, high = map(int, args.sizes.split(':'))
+        sentences = sampled(grammar, args.rule, range(low, high+1), args.number, args.seed)
+    report = fuzz(parser, sentences)
+    report.report()
+    if cache is not None:
+        cache.report()
+    sys.exit(1 if len(report.rejected)>0 else 0)
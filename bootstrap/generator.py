@@ -6,16 +6,48 @@ if rootDir not in sys.path:
     sys.path.append(rootDir)
 
 import argparse
-import functools
+import heapq
 import itertools
-import operator
+import multiprocessing
+import queue as queues
 import random
 import sys
+import traceback
 from bootstrap.grammar import Grammar
 from bootstrap.parser import Parser
-from bootstrap.util import strs
+from bootstrap.sampler import symbol_key
+from bootstrap.util import LRUDict, strs
 from bootstrap.interpreter import buildCommon, stage2
 
+
+copies = {}
+keys   = {}
+
+def exactlyOne(symbol):
+    '''A copy of the *symbol* without a modifier, made once for each symbol in the grammar.'''
+    if symbol not in copies:
+        if isinstance(symbol, Grammar.TermString):
+            copies[symbol] = Grammar.TermString(symbol.string, tag=symbol.tag, original=symbol.original)
+        elif isinstance(symbol, Grammar.TermSet):
+            copies[symbol] = Grammar.TermSet(symbol.chars, inverse=symbol.inverse, tag=symbol.tag,
+                                             original=symbol.original)
+        elif isinstance(symbol, Grammar.Nonterminal):
+            copies[symbol] = Grammar.Nonterminal(symbol.name, strength=symbol.strength)
+        else:
+            copies[symbol] = symbol
+    return copies[symbol]
+
+
+def formKey(symbols):
+    '''The comparable description of a sentential form, with the key of each symbol object computed once.'''
+    result = []
+    for s in symbols:
+        if s not in keys:
+            keys[s] = symbol_key(s)
+        result.append(keys[s])
+    return tuple(result)
+
+
 class Generator:
     def __init__(self, grammar, substitutions={}):
         self.grammar       = grammar
@@ -64,13 +96,145 @@ class Generator:
                                 print(f'f{id(form)} -> f{id(newForm)};', file=trace)
             self.forms = next
 
+    def explore(self, frontier=10000, remembered=1000000, seeds=None):
+        '''A bounded alternative to *step*. Forms and Templates wait in a priority queue with the shortest
+           sentential forms first, holding at most 2 x *frontier* entries: when the queue overflows it is cut back
+           to the *frontier* shortest. Each Form is expanded lazily, one substitution each time it is popped, before
+           it is queued again. Expanded forms, templates and emitted sentences are remembered by a hash of their
+           symbols in an LRU of *remembered* entries, so duplicates are dropped while memory stays within a fixed
+           budget. The exploration starts from the start symbol, or from the *seeds*: (symbols, phase) where the
+           phase is the number of instantiations of a Template that have already been explored elsewhere.'''
+        done    = LRUDict(remembered)
+        queue   = []
+        counter = itertools.count()
+        def push(length, item):
+            heapq.heappush(queue, (length, next(counter), item))
+            if len(queue)>2*frontier:
+                queue[:] = heapq.nsmallest(frontier, queue)
+        def fresh(key, kind):
+            key = (kind, hash(key))
+            if key in done:
+                return False
+            done.store(key, True)
+            return True
+        def expand(symbols):
+            key = formKey(symbols)
+            if fresh(key, 'f'):
+                form = self.Form(self.grammar, symbols, key)
+                push(len(symbols), (form, form.substitutions(restrict=self.substitutions)))
+        for symbols,phase in ([(form.symbols,0) for form in self.forms] if seeds is None else seeds):
+            if Generator.isTemplate(symbols):
+                template = self.Template(self.grammar, symbols, phase)
+                push(template.length(), template)
+            elif Generator.isAllTerminal(symbols):
+                yield list(symbols)
+            else:
+                expand(symbols)
+        while len(queue)>0:
+            length, _, item = heapq.heappop(queue)
+            if isinstance(item, Generator.Template):
+                symbols = item.next()
+                push(item.length(), item)
+                expand(symbols)
+                continue
+            form, substitutions = item
+            sub = next(substitutions, None)
+            if sub is None:
+                continue
+            push(length, item)
+            if Generator.isTemplate(sub):
+                if fresh(formKey(sub), 't'):
+                    template = self.Template(self.grammar, sub)
+                    push(template.length(), template)
+            elif Generator.isAllTerminal(sub):
+                if fresh(formKey(sub), 's'):
+                    yield sub
+            else:
+                expand(sub)
+
+    def shard(self, count):
+        '''Split the exploration into at least *count* independent seeds (if the language is large enough). The
+           shortest seed is replaced by its substitutions if it is a Form, and a Template hands over its next
+           instantiation while it stays a seed itself. Returns the seeds as (symbols, phase) in order of length
+           and the sentences found while splitting.'''
+        seeds, sentences, seen = [ (len(f.symbols),i,f.symbols) for i,f in enumerate(self.forms) ], [], set()
+        counter = itertools.count(len(seeds))
+        def add(symbols):
+            key = formKey(symbols)
+            if key in seen:
+                return
+            seen.add(key)
+            if Generator.isTemplate(symbols):
+                template = self.Template(self.grammar, symbols)
+                heapq.heappush(seeds, (template.length(), next(counter), template))
+            elif Generator.isAllTerminal(symbols):
+                sentences.append(symbols)
+            else:
+                heapq.heappush(seeds, (len(symbols), next(counter), tuple(symbols)))
+        while 0<len(seeds)<count:
+            _, _, seed = heapq.heappop(seeds)
+            if isinstance(seed, Generator.Template):
+                add(seed.next())
+                heapq.heappush(seeds, (seed.length(), next(counter), seed))
+            else:
+                for sub in self.Form(self.grammar, seed).substitutions(restrict=self.substitutions):
+                    add(sub)
+        seeds = [ seed for _,_,seed in sorted(seeds) ]
+        return [ (s.symbols,s.phase) if isinstance(s,Generator.Template) else (s,0) for s in seeds ], sentences
+
+    def parallel(self, workers, frontier=10000, remembered=1000000, batch=64):
+        '''Explore across *workers* processes. The seeds from *shard* are dealt round-robin to the workers, each
+           runs *explore* over its seeds and sends sentences back in batches. The batches are merged into one
+           stream in the order they arrive, dropping duplicates between shards. The workers are stopped when the
+           stream is closed. A worker that raises, or dies without finishing, raises ShardFailed here.'''
+        seeds, sentences = self.shard(4*workers)
+        shards = [ seeds[i::workers] for i in range(workers) ]
+        done = LRUDict(remembered)
+        def fresh(sentence):
+            key = hash(tuple(map(symbol_key, sentence)))
+            if key in done:
+                return False
+            done.store(key, True)
+            return True
+        for sentence in sentences:
+            if fresh(sentence):
+                yield sentence
+        queue = multiprocessing.Queue(maxsize=4*workers)
+        processes = [ multiprocessing.Process(target=exploreShard,
+                                              args=(self.grammar, self.substitutions, shard, frontier, remembered,
+                                                    batch, queue), daemon=True)
+                      for shard in shards if len(shard)>0 ]
+        try:
+            for p in processes:
+                p.start()
+            running = len(processes)
+            while running>0:
+                try:
+                    sentences = queue.get(timeout=1)
+                except queues.Empty:
+                    if not any(p.is_alive() for p in processes):
+                        raise ShardFailed(f'Workers exited with {[p.exitcode for p in processes]}')
+                    continue
+                if sentences is None:
+                    running -= 1
+                    continue
+                if isinstance(sentences, ShardFailed):
+                    raise sentences
+                for sentence in sentences:
+                    if fresh(sentence):
+                        yield sentence
+        finally:
+            for p in processes:
+                p.terminate()
+                p.join()
+
     @staticmethod
     def isTemplate(symbols):
         return any([s.modifier in ("any","some") for s in symbols])
 
     @staticmethod
     def isAllTerminal(symbols):
-        return all([s.isTerminal() for s in symbols])
+        return all([not s.isNonterminal for s in symbols])
 
     @staticmethod
     def dotTemplate(output, gen):
@@ -123,10 +287,13 @@ class Generator:
            The enumeration of the counts is fair - rather than increment one count indefinitely and "starve" the
            other counts of increments. The trick here is the same as proving that tuples are in a bijection with
            the integers by "zig zagging" through the space rather than iterating parallel to an axis. We iterate
-           over all tuples with the same sum, and then increase the sum.'''
-        def __init__(self, grammar, symbols):
+           over all tuples with the same sum, and then increase the sum.
+
+           A Template can be resumed elsewhere by skipping the first *phase* instantiations.'''
+        def __init__(self, grammar, symbols, phase=0):
             self.grammar   = grammar
             self.symbols   = tuple(symbols)
+            self.key       = formKey(symbols)
             self.positions = ()
             self.offset    = ()
 
@@ -139,34 +306,45 @@ class Generator:
                     self.offset    += (1,)
 
             self.total     = 0
+            self.phase     = phase
             self.tuples    = Generator.tuples(len(self.positions), self.total)
             self.nextTuple = next(self.tuples)
+            for i in range(phase):
+                self.advance()
 
         def __str__(self):
             return f"Template({strs(self.symbols)}@{self.nextTuple})"
 
         def __eq__(self, other):
-            return isinstance(other,Generator.Template) and self.symbols==other.symbols
+            return isinstance(other,Generator.Template) and self.key==other.key
 
         def __hash__(self):
-            return hash(self.symbols)
+            return hash(self.key)
+
+        def length(self):
+            '''The number of symbols in the next instantiation.'''
+            return len(self.symbols) - len(self.positions) + sum(self.nextTuple) + sum(self.offset)
 
         def next(self):
             result = self.instantiate(tuple(h+o for h,o in zip(self.nextTuple,self.offset)))
+            self.phase += 1
+            self.advance()
+            return result
+
+        def advance(self):
             try:
                 self.nextTuple = next(self.tuples)
             except StopIteration:
                 self.total += 1
                 self.tuples    = Generator.tuples(len(self.positions), self.total)
                 self.nextTuple = next(self.tuples)
-            return result
 
         def instantiate(self, counts):
             result = []
             position = 0
             for s in self.symbols:
                 if s.modifier in ("any","some"):
-                    result.extend([s.exactlyOne()] * counts[position])
+                    result.extend([exactlyOne(s)] * counts[position])
                     position += 1
                 else:
                     result.append(s)
@@ -177,9 +355,10 @@ class Generator:
         '''A sentential form (sequence of *symbols* derived from the grammar) without any repeating modifiers (only
            optional or just). This can be used to generate a finite family of forms/sentences by substitution of
            non-terminals.'''
-        def __init__(self, grammar, symbols):
+        def __init__(self, grammar, symbols, key=None):
             self.grammar = grammar
             self.symbols = tuple(symbols)
+            self.key     = formKey(symbols) if key is None else key
             for s in symbols:
                 assert s.modifier in ('just', 'optional'), s.modifier
 
@@ -189,26 +368,47 @@ class Generator:
         def substitutions(self, restrict={}):
             variations = []
             for s in self.symbols:
-                if s.isTerminal():
-                    if s.modifier=="optional":
-                        variations.append([[], [s.exactlyOne()]])
-                    else:
-                        variations.append([[s]])
+                empty = [[]] if s.modifier=="optional" else []
+                if s.isTerminal:
+                    variations.append(empty + [[exactlyOne(s)]])
                 elif isinstance(s,Grammar.Nonterminal) and s.name not in restrict:
-                    variations.append([list(clause.rhs) for clause in self.grammar.rules[s.name].clauses])
+                    variations.append(empty + [list(clause.rhs) for clause in self.grammar.rules[s.name].clauses])
                 elif isinstance(s,Grammar.Nonterminal) and s.name in restrict:
-                    variations.append([[Grammar.TermString(random.choice(restrict[s.name]))]])
+                    choice = (s.name, random.choice(restrict[s.name]))
+                    if choice not in copies:
+                        copies[choice] = Grammar.TermString(choice[1])
+                    variations.append(empty + [[copies[choice]]])
+                else:
+                    variations.append([[s]])
 
-            cart_product = itertools.product(*variations)
-            for sentenceParts in cart_product:
-                sentence = functools.reduce(operator.iconcat, sentenceParts, [])
-                yield sentence
+            for sentenceParts in itertools.product(*variations):
+                yield list(itertools.chain.from_iterable(sentenceParts))
 
         def __eq__(self, other):
-            return isinstance(other,Generator.Form) and self.symbols==other.symbols
+            return isinstance(other,Generator.Form) and self.key==other.key
 
         def __hash__(self):
-            return hash(self.symbols)
+            return hash(self.key)
+
+class ShardFailed(Exception):
+    '''A worker process in Generator.parallel failed, the message holds the traceback from the worker.'''
+
+
+def exploreShard(grammar, substitutions, seeds, frontier, remembered, batch, queue):
+    '''The body of a worker process for Generator.parallel. The worker always finishes with None on the *queue*,
+       an exception is sent ahead of it as a ShardFailed.'''
+    try:
+        sentences = Generator(grammar, substitutions).explore(frontier, remembered, seeds)
+        while True:
+            chunk = list(itertools.islice(sentences, batch))
+            if len(chunk)==0:
+                break
+            queue.put(chunk)
+    except BaseException:
+        queue.put(ShardFailed(traceback.format_exc()))
+    finally:
+        queue.put(None)
+
 
 if __name__=='__main__':
     argParser = argparse.ArgumentParser()
@@ -216,10 +416,12 @@ if __name__=='__main__':
     argParser.add_argument("-n", "--number", type=int, default=10)
     argParser.add_argument("-t", "--tag", action='append')
     argParser.add_argument("-s", "--substitute", action='append')
+    argParser.add_argument("-f", "--frontier", type=int, help="explore with a bounded frontier of this size")
+    argParser.add_argument("-j", "--jobs", type=int, help="explore in parallel across this many processes")
     args = argParser.parse_args()
     def flattenKvs(pairs):
         result = {}
-        for tpair in pairs:
+        for tpair in pairs or []:
             name,value = tpair.split("=")
             if not name in result:
                 result[name] = []
@@ -228,17 +430,25 @@ if __name__=='__main__':
     tags = flattenKvs(args.tag)
     substitutions = flattenKvs(args.substitute)
 
-    stage1g, stage1 = buildCommon()
-    res = next(stage1.parse( open(args.grammar).read()), None)
+    stage1g, _, stage1 = buildCommon()
+    res = next(stage1.execute( open(args.grammar).read()), None)
     if res is None:
         print(f"Failed to parse grammar from {args.grammar}")
         sys.exit(-1)
     grammar = stage2(res)
     generator = Generator(grammar, substitutions=substitutions)
-    for sentence in itertools.islice(generator.step(), args.number):
+    if args.jobs is not None:
+        sentences = generator.parallel(args.jobs, args.frontier or 10000)
+    elif args.frontier is not None:
+        sentences = generator.explore(args.frontier)
+    else:
+        sentences = generator.step()
+    for sentence in itertools.islice(sentences, args.number):
         emit = []
         for symb in sentence:
-            if symb.string is not None:
+            if not symb.isTerminal:
+                continue
+            if isinstance(symb, Grammar.TermString):
                 emit.append(symb.string)
             elif symb.tag in tags:
                 emit.append(random.choice(tags[symb.tag]))
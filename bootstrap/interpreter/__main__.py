@@ -11,8 +11,10 @@ import traceback
 
 from bootstrap.interpreter import buildPidginParser, Box, Type, TypingFailed, \
                                   BlockBuilder, Execution, ProgramBuilder
+from bootstrap.interpreter.execution import Profile
+import bootstrap.interpreter.log as log
 import bootstrap.interpreter.builtins as builtins
-from bootstrap.parser import Token
+from bootstrap.parser import Recovery, Token
 from bootstrap.util import dump
 
 
@@ -21,7 +23,12 @@ argParser.add_argument("-i", "--input")
 argParser.add_argument("-f", "--file")
 argParser.add_argument("-s", "--start", default="expr")
 argParser.add_argument("-d", "--dumpast", action="store_true")
+argParser.add_argument("-r", "--recover", action="store_true")
+argParser.add_argument("-v", "--verbose", action="count", default=0, help="repeat for debug and trace messages")
+argParser.add_argument("-e", "--events", help="write the messages as JSON lines to this file")
+argParser.add_argument("-p", "--profile", action="store_true", help="report hot blocks and write profile.dot")
 args = argParser.parse_args()
+log.configure(args.verbose, eventFile=None if args.events is None else open(args.events,'wt'))
 
 if args.input is None and args.file is None:
     print("Must supply input or file")
@@ -35,13 +42,24 @@ if args.input is not None:
     rawInput = args.input
 if args.file is not None:
     rawInput = open(args.file).read()
+wrapper = 'func main:int [stdin:string] {'
 if args.start == 'main':
-    rawInput = 'func main:int [stdin:string] {\n' + rawInput + '\nreturn 0}'
-trees = list(parser.execute(rawInput, True))
+    # Wrap without a newline so that line numbers in diagnostics match the program text
+    rawInput = wrapper + rawInput + '\nreturn 0}'
+trees = list(parser.execute(rawInput, True, recovery=Recovery() if args.recover else None))
+if args.start == 'main':
+    # and discount the wrapper from the columns on the first line
+    parser.lines.prefix = len(wrapper)
 parser.trace.output(open('inttrace.dot','wt'))
 
-if len(trees)==0:
+if len(trees)==0 or len(parser.errors[0])>0:
     print("Parse error")
+    if len(trees)>0:
+        # Report the cheapest repair, the first tree, rather than mixing the alternatives
+        for e in parser.errors[0]:
+            print(f"Repaired {parser.lines.describe(e.start)}: popped {' '.join(str(c) for c in e.children)} skipped {repr(e.span)}")
+        if args.dumpast:
+            dump(trees[0])
     sys.exit(-1)
 if len(trees)>1:
     print(f"Warning: input is ambiguous, had {len(trees)} distinct parses")
@@ -65,17 +83,29 @@ elif args.start=='program' or args.start=='main':
     try:
         root = trees[0] if isinstance(trees[0], Token) else (trees[0],)
         progBuilder = ProgramBuilder(root)
-        progBuilder.outermost.dump()
+        if log.debug:
+            log.emit('translate.program', log.capture(progBuilder.outermost.dump))
     except TypingFailed as e:
         traceback.print_exc()
+        print(f'Type error at {e.location(parser.lines)}')
         dump(e.tree)
         sys.exit(-1)
     progBuilder.outermost.children['main'].dot(open('ssa.dot','wt'))
     progBuilder.typeEnv.wipe()
-    progBuilder.typeEnv.dump()
     input = sys.stdin.read()
-    e = Execution(progBuilder.outermost, progBuilder.typeEnv, input=input)
-    while e.step():
-        pass
+    profile = Profile() if args.profile else None
+    e = Execution(progBuilder.outermost, progBuilder.typeEnv, input=input, lines=parser.lines, profile=profile)
+    try:
+        if log.trace:
+            while e.step():
+                pass
+        else:
+            e.run()
+    except:
+        print(f'Execution failed at {e.location()}')
+        raise
+    if profile is not None:
+        profile.report()
+        profile.dot(progBuilder.outermost.children['main'], open('profile.dot','wt'))
 else:
     assert False, "Unexpected entry point {args.start}"
@@ -6,6 +6,25 @@ from .types import Type
 from ..parser import Parser, Token
 from ..util import dump
 
+class Iterator:
+    '''The raw value of an iterator Box: it references the collection (order, set, map or string) rather than
+       copying it, and holds the next element so that checking for more elements does not consume one.'''
+    end = object()
+    __slots__ = ('source', 'current')
+
+    def __init__(self, collection):
+        self.source = iter(collection)
+        self.current = next(self.source, Iterator.end)
+
+    def more(self):
+        return self.current is not Iterator.end
+
+    def advance(self):
+        value = self.current
+        self.current = next(self.source, Iterator.end)
+        return value
+
+
 class Box:
     def __init__(self, type, raw=None):
         self.type = type
@@ -1,6 +1,7 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from . import log
 from .irep import Instruction, Value
 from ..util import strs
 
@@ -13,17 +14,21 @@ def eliminatePhi(func):
             for inst in block.instructions:
                 if not inst.isPhi():    continue
                 if inst in inst.uses:
-                    print(f'Eliminate self-loop on phi {inst}')
+                    if log.debug:
+                        log.emit('phi.selfloop', f'Eliminate self-loop on phi {inst}', phi=inst.label)
                     inst.uses = [ u for u in inst.uses if u != inst ]
                     inst.values = tuple(v for v in inst.values if v.instruction!=inst)
                 unique = set(inst.values)
                 if len(unique)!=len(inst.values):
-                    print(f'Eliminate duplicate inputs for phi {inst} => {unique}')
+                    if log.debug:
+                        log.emit('phi.duplicates', f'Eliminate duplicate inputs for phi {inst} => {strs(unique)}',
+                                 phi=inst.label)
                     inst.values = tuple(unique)
-                else:
-                    print(f'No dups for {inst} in {strs(unique)}')
+                elif log.trace:
+                    log.emit('phi.unique', f'No dups for {inst} in {strs(unique)}', phi=inst.label)
                 if len(inst.values)==1:
-                    print(f'Eliminate redundant phi {inst}')
+                    if log.debug:
+                        log.emit('phi.redundant', f'Eliminate redundant phi {inst}', phi=inst.label)
                     for eachUse in inst.uses:
                         eachUse.replace(inst, inst.values[0])
                     delete.append(inst)
@@ -1,9 +1,16 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from dataclasses import dataclass, field
+import collections
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Union
 
+from . import log
+from .defuse import calcDefUse
 from .irep import Block, Instruction, Function
+from .numbering import numberSlots
 from .box import Box, Type
 from .frontend import AST
 from .typecheck import TypedEnvironment
@@ -11,122 +18,384 @@ from ..parser import Token
 from ..util import dump
 
 
+def unboxed(t):
+    '''NUMBER and BOOL values are held as plain Python values inside frames and environments, they are only boxed
+       when they cross into a collection, a builtin or a call.'''
+    return t is not None  and  (t.isNumber() or t.isBool())
+
+
+# A frame slot holds a Box, or the plain int or bool of an unboxed NUMBER or BOOL value (see rawSlot).
+Slot = Union[Box, int, bool]
+
+
+def nameType(function, name, default=None):
+    return function.typeEnv.types.get(name, default)
+
+
+def rawSlot(function, inst):
+    '''Is the value computed by *inst* held unboxed? Named values follow the type of the name so that stores, loads
+       and phis agree on what is in the environment.'''
+    if inst.isLoad() or inst.isPhi() or inst.isStore():
+        return unboxed(nameType(function, inst.name, inst.theType))
+    return inst.unboxed is not None  and  unboxed(inst.theType)
+
+
+def owned(function, inst):
+    '''Can the collection update *inst* mutate its input in place? The input must be a fresh collection (from new
+       or another update) earlier in the same block, that has no other use either as an operand or as a returned
+       value.'''
+    source = inst.values[0].instruction
+    if source is None  or  inst.values[0].output is not None  or  source in function.returned  or \
+       source.block is not inst.block:
+        return False
+    if source.op!='new'  and  source.inplace is None:
+        return False
+    return len(source.uses)==1  and  inst in source.uses  and \
+           all(v.instruction is not source for v in inst.values[1:])
+
+
+def operand(function, value, raw=False):
+    '''Resolve where a Value will be found ahead of time, returning an accessor that takes a Frame, so that
+       there are no checks on each use. The accessor converts from the representation of the source to a Box,
+       or to a raw Python value when *raw* is set. The instructions must already have been numbered into
+       slots.'''
+    if value.constant is not None:
+        constant = value.constant.raw if raw else value.constant
+        return lambda frame: constant
+    if value.output is not None and value.instruction is not None:
+        slot, output = value.instruction.slot, value.output
+        if raw:
+            return lambda frame: frame.values[slot][output].raw
+        return lambda frame: frame.values[slot][output]
+    if value.instruction is not None:
+        slot = value.instruction.slot
+        source = rawSlot(function, value.instruction)
+        if source==raw:
+            return lambda frame: frame.values[slot]
+        if raw:
+            return lambda frame: frame.values[slot].raw
+        t = nameType(function, value.instruction.name, value.instruction.theType)
+        return lambda frame: Box(t, frame.values[slot])
+    if value.argument is not None:
+        name, t = value.argument, nameType(function, value.argument)
+        if unboxed(t)==raw:
+            return lambda frame: frame.env.values[name]
+        if raw:
+            return lambda frame: frame.env.values[name].raw
+        return lambda frame: Box(t, frame.env.values[name])
+    assert False, f'Cannot compile operand {value}'
+
+
+class Profile:
+    '''Opt-in instrumentation for an Execution: the number of times that each Block and Instruction executes, the
+       time spent in each builtin and the time spent in frames of each function. The function times are inclusive
+       of the functions that they call.'''
+    def __init__(self):
+        self.blocks        = collections.Counter()
+        self.instructions  = collections.Counter()
+        self.builtinTime   = collections.Counter()
+        self.builtinCalls  = collections.Counter()
+        self.functionTime  = collections.Counter()
+        self.functionCalls = collections.Counter()
+        self.owners        = {}
+        self.started       = []
+
+    def count(self, inst, op):
+        counter = self.instructions
+        def counted(frame):
+            counter[inst] += 1
+            return op(frame)
+        return counted
+
+    def countBlock(self, block, exit):
+        counter = self.blocks
+        def counted(frame):
+            counter[block] += 1
+            return exit(frame)
+        return counted
+
+    def timeBuiltin(self, name, op):
+        def timed(frame):
+            started = time.perf_counter()
+            op(frame)
+            self.builtinTime[name] += time.perf_counter() - started
+            self.builtinCalls[name] += 1
+        return timed
+
+    def timeCall(self, op):
+        def timed(frame):
+            callee = op(frame)
+            self.started.append(time.perf_counter())
+            return callee
+        return timed
+
+    def enter(self):
+        self.started.append(time.perf_counter())
+
+    def leave(self, function):
+        self.functionTime[function.name] += time.perf_counter() - self.started.pop()
+        self.functionCalls[function.name] += 1
+
+    def report(self, file=sys.stdout, top=10):
+        print('Hot blocks:', file=file)
+        for block, count in self.blocks.most_common(top):
+            print(f'  {self.owners[block].name} {block}: {count}', file=file)
+            for i, inst in enumerate(block.instructions):
+                print(f'    {block.label}_{i} x{self.instructions[inst]}: {inst}', file=file)
+        for name, seconds in self.functionTime.most_common():
+            print(f'  function {name}: {seconds:.4f}s over {self.functionCalls[name]} calls', file=file)
+        for name, seconds in self.builtinTime.most_common():
+            print(f'  builtin {name}: {seconds:.4f}s over {self.builtinCalls[name]} calls', file=file)
+
+    def dot(self, function, output):
+        '''Write the SSA graph of the *function* coloured by the hotness of each Block.'''
+        function.dot(output, counts=self.blocks + self.instructions)
+
+
 class Execution:
     @dataclass
     class Frame:
+        '''The state of one call: the Block and the position in it of the next instruction, the environment and
+           one slot per numbered instruction. A slot is None until its instruction has run. Instructions that
+           rawSlot picks out store plain ints and bools, every other slot holds a Box.'''
         function: Function
         current: Block
         position: int
         env: TypedEnvironment
-        values: dict[Instruction,Box] = field(default_factory=dict)
+        values: list[Slot]
 
-        def resolve(self, value):
-            if value.constant is not None:
-                return value.constant
-            if value.output is not None and value.instruction is not None:
-                return self.values[value.instruction][value.output]
-            if value.instruction is not None:
-                return self.values[value.instruction]
-            if value.argument is not None:
-                return self.env.values[value.argument]
+        @staticmethod
+        def enter(function, env):
+            return Execution.Frame(function, function.entry, 0, env, [None]*function.slots)
 
-            assert False, f'Cannot resolve {value} in frame'
+    @dataclass
+    class Code:
+        '''The compiled form of a Block: one closure per instruction that takes the Frame and either returns None,
+           or the Frame for a call that must be pushed. The exit closure picks the successor Block, or None when
+           the Block leaves the function and result (if any) fetches the returned value.'''
+        block: Block
+        ops: list[Callable]
+        exit: Callable
+        result: Callable = None
 
-    def __init__(self, outermost, initialEnv, input=''):
+    def __init__(self, outermost, initialEnv, input='', lines=None, profile=None):
+        '''Passing a Profile as *profile* instruments the compiled code to record where the program spends its
+           time.'''
         self.outermost = outermost
+        self.lines = lines
+        self.profile = profile
+        self.code = {}
+        self.compiled = set()
         main = outermost.children['main']
         mainEnv = main.typeEnv.makeCopy()
         mainEnv.add('stdin', Type.STRING())
         mainEnv.set('stdin', Box(Type.STRING(),raw=input))
-        print('Setting up initial stack, main env:')
-        mainEnv.dump()
-        self.stack = [Execution.Frame(main, main.entry, 0, mainEnv)]
+        if log.info:
+            log.emit('execution.start', 'Setting up initial stack, main env:\n' + log.capture(mainEnv.dump))
+        self.prepare(main)
+        self.stack = [Execution.Frame.enter(main, mainEnv)]
+        if profile is not None:
+            profile.enter()
+
+    def prepare(self, function):
+        '''Compile every reachable Block in the function (and the functions that it calls) once, before any of
+           them execute.'''
+        if function in self.compiled:
+            return
+        self.compiled.add(function)
+        numberSlots(function)
+        calcDefUse(function)
+        function.returned = set( block.defs['%return%'].instruction for block in function.blocks
+                             if '%return%' in block.defs )
+        for block in function.blocks:
+            self.code[block] = self.compileBlock(function, block)
+
+    def compileBlock(self, function, block):
+        ops = [ self.compileInstruction(function, inst) for inst in block.instructions ]
+        result = None
+        if block.trueSucc is None:
+            exit = lambda frame: None
+            if '%return%' in block.defs:
+                result = operand(function, block.defs['%return%'])
+        elif block.falseSucc is None:
+            succ = block.trueSucc
+            exit = lambda frame: succ
+        else:
+            conditional = block.instructions[-1]
+            assert conditional.theType is None or conditional.theType.isBool(), f'Block conditional has wrong type'
+            trueSucc, falseSucc, slot = block.trueSucc, block.falseSucc, conditional.slot
+            if rawSlot(function, conditional):
+                exit = lambda frame: trueSucc if frame.values[slot] else falseSucc
+            else:
+                exit = lambda frame: trueSucc if frame.values[slot].raw else falseSucc
+        if self.profile is not None:
+            self.profile.owners[block] = function
+            ops = [ self.profile.count(inst, op) for inst, op in zip(block.instructions, ops) ]
+            exit = self.profile.countBlock(block, exit)
+        return Execution.Code(block, ops, exit, result)
+
+    def compileInstruction(self, function, inst):
+        slot = inst.slot
+        if inst.unboxed is not None  and  rawSlot(function, inst):
+            unboxedOp = inst.unboxed
+            inputs = [ operand(function, v, raw=True) for v in inst.values ]
+            if len(inputs)==1:
+                first = inputs[0]
+                def op(frame):
+                    frame.values[slot] = unboxedOp(first(frame))
+                return op
+            if len(inputs)==2:
+                first, second = inputs
+                def op(frame):
+                    frame.values[slot] = unboxedOp(first(frame), second(frame))
+                return op
+        if inst.inplace is not None  and  owned(function, inst):
+            update = inst.inplace
+            collection, value = [ operand(function, v) for v in inst.values ]
+            def op(frame):
+                box = collection(frame)
+                update(box.raw, value(frame))
+                frame.values[slot] = box
+            return op
+        if inst.transfer is not None:
+            transfer = inst.transfer
+            inputs = [ operand(function, v) for v in inst.values ]
+            if len(inputs)==0:
+                def op(frame):
+                    frame.values[slot] = transfer(())
+            elif len(inputs)==1:
+                first = inputs[0]
+                def op(frame):
+                    frame.values[slot] = transfer((first(frame),))
+            elif len(inputs)==2:
+                first, second = inputs
+                def op(frame):
+                    frame.values[slot] = transfer((first(frame),second(frame)))
+            else:
+                def op(frame):
+                    frame.values[slot] = transfer(tuple(i(frame) for i in inputs))
+            return op
+        if inst.isCall():
+            fType = function.typeEnv.types[inst.function]
+            argument = operand(function, inst.values[0])
+            if fType.isBuiltin():
+                builtin = fType.builtin
+                def op(frame):
+                    frame.values[slot] = builtin(argument(frame))
+                if self.profile is not None:
+                    return self.profile.timeBuiltin(inst.function, op)
+                return op
+            callee = fType.function
+            self.prepare(callee)
+            rawNames = set( name for name,t in callee.typeEnv.types.items() if unboxed(t) )
+            def op(frame):
+                args = argument(frame)
+                assert args.type.isRecord(), f'Cannot bind argument into child env, not record?'
+                callEnv = callee.typeEnv.makeCopy()
+                for k,v in args.raw.items():
+                    callEnv.set(k,v)
+                    if k in rawNames:
+                        callEnv.values[k] = v.raw
+                return Execution.Frame.enter(callee, callEnv)
+            if self.profile is not None:
+                return self.profile.timeCall(op)
+            return op
+        if inst.isLoad() or inst.isPhi():
+            assert inst.name is not None, f'Cannot compile unnamed {inst}'
+            name = inst.name
+            def op(frame):
+                frame.values[slot] = frame.env.values[name]
+            return op
+        if inst.isStore():
+            name = inst.name
+            value = operand(function, inst.values[0], raw=rawSlot(function, inst))
+            def op(frame):
+                frame.values[slot] = frame.env.values[name] = value(frame)
+            return op
+        assert False, f'Cannot compile {inst}'
+
+    def location(self):
+        '''Describe the source location of the instruction about to execute, using the line index of the
+           program text when one was supplied.'''
+        if len(self.stack)==0:
+            return 'end of program'
+        frame = self.stack[-1]
+        if frame.position >= len(frame.current.instructions):
+            return f'exit of {frame.current}'
+        source = frame.current.instructions[frame.position].source
+        if self.lines is None:
+            return f'offset {source}'
+        return self.lines.describe(source)
+
+    def leave(self, frame, code):
+        '''Pop the frame for a function whose final Block has finished, passing the result back to the call that
+           is waiting in the caller. Returns False when the program itself has finished.'''
+        if self.profile is not None:
+            self.profile.leave(frame.function)
+        if len(self.stack)==1:
+            for name, value in frame.env.values.items():
+                if unboxed(frame.env.types.get(name)):
+                    frame.env.values[name] = Box(frame.env.types[name], value)
+            if log.info:
+                log.emit('execution.done', log.capture(frame.env.dump) + '\nDone.')
+            self.stack.pop()
+            return False
+        result = code.result(frame) if code.result is not None else None
+        self.stack.pop()
+        caller = self.stack[-1]
+        caller.values[caller.current.instructions[caller.position].slot] = result
+        caller.position += 1
+        return True
 
     def step(self):
+        '''Execute a single instruction or Block exit, tracing each one. The run method is the fast path.'''
         if len(self.stack)==0:
             return False
         frame = self.stack[-1]
-        if frame.position >= len(frame.current.instructions):
-            if frame.current.trueSucc is None:
-                if len(self.stack)==1:
-                    frame.env.dump()
-                    print('Done.')
-                    return False
-                result = frame.values[ frame.current.defs['%return%'] ]
-                print(f'Returned len={len(self.stack)} with {result}')
-                self.stack = self.stack[:-1]
-                frame = self.stack[-1]
+        code = self.code[frame.current]
+        if frame.position < len(code.ops):
+            if log.trace:
                 inst = frame.current.instructions[frame.position]
-                frame.values[inst] = result
-                frame.position += 1
-                return True
-            if frame.current.falseSucc is None:
-                frame.current = frame.current.trueSucc
-                frame.position = 0
-                return True
-            conditional = frame.current.instructions[frame.position-1]
-            print(f'Conditional jump {frame.values[conditional]} t={frame.current.trueSucc} f={frame.current.falseSucc}')
-            assert frame.values[conditional].type.isBool(), f'Block conditional has wrong type'
-            if frame.values[conditional].raw:
-                frame.current = frame.current.trueSucc
+                log.emit('execution.step', f'step {frame.current.label}_{frame.position}: {inst}',
+                         block=frame.current.label, position=frame.position, op=inst.op)
+            callee = code.ops[frame.position](frame)
+            if callee is not None:
+                self.stack.append(callee)
             else:
-                frame.current = frame.current.falseSucc
-            frame.position = 0
-            return True
-        inst = frame.current.instructions[frame.position]
-        print(f'step {frame.current.label}_{frame.position}: {inst}')
-        if hasattr(inst, 'transfer')  and  getattr(inst, 'transfer') is not None:
-            result = inst.transfer(tuple(frame.resolve(v) for v in inst.values))
-            frame.values[inst] = result
-            print(f' = {result}')
-            frame.position += 1
-            return True
-        if inst.isCall():
-            fType = frame.env.types[inst.function]
-            if fType.isBuiltin():
-                print(f'calling builtin {inst.function} env: {",".join(frame.env.values.keys())}')
-                arg = frame.resolve(inst.values[0])
-                result = fType.builtin(arg)
-                frame.values[inst] = result
                 frame.position += 1
-                return True
-            function = fType.function
-            callEnv = function.typeEnv.makeCopy()
-            args = frame.values[inst.values[0]]
-            assert args.type.isRecord(), f'Cannot bind argument into child env, not record?'
-            for k,v in args.raw.items():
-                #callEnv.add(k,v.type)
-                callEnv.set(k,v)
-            self.stack.append( Execution.Frame(function, function.entry, 0, callEnv) )
             return True
-        if inst.isLoad():
-            frame.values[inst] = frame.env.values[inst.name]
-            frame.position += 1
-            return True
-        if inst.isStore():
-            value = frame.resolve(inst.values[0])
-            print(f'Stored {value} as {inst.name}')
-            frame.env.values[inst.name] = value
-            frame.values[inst] = value
-            frame.env.dump()
-            frame.position += 1
+        successor = code.exit(frame)
+        if successor is not None:
+            frame.current = successor
+            frame.position = 0
             return True
-        if inst.isPhi():
-            if inst.name is None:
-                assert False
-            else:
-                result = frame.env.values[inst.name]
-                frame.values[inst] = result
-                frame.position += 1
-                print(f'Phi of {inst.name} resolved to {result}')
-                return True
-#        if inst.isIterAccess():
-#            iterator = frame.values[inst.values[0]]
-#            val = iterator.raw[2][iterator.raw[0]]
-#            newIt = Box
-#            iterator.raw[0] += 1    # TODO: don't update existing value
-#            frame.values[inst] = val
-#            frame.position += 1
-#            return True
-        assert False
+        return self.leave(frame, code)
 
+    def run(self):
+        '''Execute the program until it finishes. Each Block runs as a tight loop over its compiled closures, the
+           stack is only inspected at calls, returns and Block exits.'''
+        stack, allCode = self.stack, self.code
+        while len(stack)>0:
+            frame = stack[-1]
+            code = allCode[frame.current]
+            ops = code.ops
+            position, length = frame.position, len(ops)
+            callee = None
+            try:
+                while position < length:
+                    callee = ops[position](frame)
+                    if callee is not None:
+                        break
+                    position += 1
+            finally:
+                # Written back on every exit, including an op raising, so that location() names the instruction.
+                frame.position = position
+            if callee is not None:
+                stack.append(callee)
+                continue
+            successor = code.exit(frame)
+            if successor is not None:
+                frame.current = successor
+                frame.position = 0
+                continue
+            self.leave(frame, code)
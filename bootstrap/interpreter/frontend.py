@@ -348,6 +348,7 @@ ntTransformer = {
     'kv_pair':      (lambda node: AST.KeyVal(node.children[0], node.children[2])),
     'map':          (lambda node: AST.Map(node.children[1:-1])),
     'name_type':    (lambda node: AST.NameType(node.children[0].span, node.children[2])),
+    'number':       (lambda node: AST.NumberLit("".join(str(c.content) for c in node.children))),
     'order':        (lambda node: AST.Order(removeFinalComma(node.children[1:-1]))),
     'order_pair':   (lambda node: node.children[0]),
     'record':       (lambda node: AST.Record(node.children[1:-1])),
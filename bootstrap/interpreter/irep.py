@@ -1,12 +1,21 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .box import Box
+import copy
+import operator
+import sys
+
+from . import log
+from .box import Box, Iterator
 from .types import Type
 
 class Instruction:
+    '''The transfer function computes the output Box from the operand Boxes. Arithmetic and comparisons also have
+       an unboxed form that works on raw Python values, and collection updates have an inplace form that mutates
+       the raw value of their first operand. The inplace form is only valid when nothing else can observe the
+       input afterwards.'''
     def __init__(self, op, *values, function=None, name=None, theType=None, outTypes=None, box=None, transfer=None,
-                 position=None):
+                 position=None, unboxed=None, inplace=None):
         self.op = op
         self.values = values
         for v in values:
@@ -19,7 +28,10 @@ class Instruction:
         self.label = "unassigned"
         self.position = position
         self.transfer = transfer
+        self.unboxed = unboxed
+        self.inplace = inplace
         self.block = None
+        self.source = None
 
     def __str__(self):
         fields = []
@@ -34,12 +46,14 @@ class Instruction:
             fieldStr = ''
         return f'{self.op}({",".join(str(v) for v in self.values)}{fieldStr})'
 
-    def dotNode(self, blockName, output):
+    def dotNode(self, blockName, output, count=None):
         cellLabel = self.op
         if self.name is not None:
             cellLabel += ' ' + self.name
         if self.function is not None:
             cellLabel += ' ' + self.function
+        if count is not None:
+            cellLabel += f' x{count}'
 #        if len(self.values)>0:
 #            inPorts = [ f'<TD PORT="in{i}" HEIGHT="6" WIDTH="6" FIXEDSIZE="TRUE"><FONT POINT-SIZE="6">{i}</FONT></TD>'
 #                        for i in range(len(self.values)) ]
@@ -119,7 +133,8 @@ class Instruction:
     @staticmethod
     def ADD_NUMBER(lhs, rhs):
         t = Type.NUMBER()
-        return Instruction("add", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw + vs[1].raw))
+        return Instruction("add", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw + vs[1].raw),
+                           unboxed=operator.add)
 
     @staticmethod
     def CALL(target, retType, argument):
@@ -128,43 +143,46 @@ class Instruction:
     @staticmethod
     def EQUAL(lhs, rhs):
         t = Type.BOOL()
-        return Instruction("equal", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw == vs[1].raw))
+        return Instruction("equal", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw == vs[1].raw),
+                           unboxed=operator.eq)
 
     @staticmethod
     def GREAT(lhs, rhs):
         t = Type.BOOL()
-        return Instruction("great", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw > vs[1].raw))
+        return Instruction("great", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw > vs[1].raw),
+                           unboxed=operator.gt)
 
     @staticmethod
     def INEQUAL(lhs, rhs):
         t = Type.BOOL()
-        return Instruction("inequal", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw != vs[1].raw))
+        return Instruction("inequal", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw != vs[1].raw),
+                           unboxed=operator.ne)
 
     @staticmethod
     def ITER_INIT(collection):
-        print(f'Init iterator from {type(collection)} {collection.type()}')
+        if log.debug:
+            log.emit('translate.iterator', f'Init iterator from {type(collection)} {collection.type()}')
         itType = Type.ITERATOR(collection.type().param1)      # NOTE: Will be different for maps
-        return Instruction("iter_init", collection, theType=itType,
-                           transfer=lambda vs: Box(itType, (0,len(vs[0].raw),tuple(vs[0].raw))))
+        return Instruction("iter_init", collection, theType=itType, transfer=lambda vs: Box(itType, Iterator(vs[0].raw)))
 
     def ITER_CHECK(iterator):
         t = Type.BOOL()
-        return Instruction("iter_check", iterator, theType=t, transfer=lambda vs: Box(t, vs[0].raw[0]<vs[0].raw[1]))
+        return Instruction("iter_check", iterator, theType=t, transfer=lambda vs: Box(t, vs[0].raw.more()),
+                           unboxed=Iterator.more)
 
     def ITER_ACCESS(iterator):
         '''Output 0 is the new iterator state
-           Output 1 is the iterated value.'''
+           Output 1 is the iterated value.
+           The state advances in place: the loop translation never uses the input state after the access.'''
         t = iterator.type()
         return Instruction("iter_access", iterator, outTypes=(t,t.param1),
-                           transfer=lambda vs: (Box(t, (vs[0].raw[0]+1, vs[0].raw[1], vs[0].raw[2])),
-                                                # Box(t.param1, vs[0].raw[2][vs[0].raw[0].raw]) ) boxes are immutable
-                                                vs[0].raw[2][vs[0].raw[0]] )
-                          )
+                           transfer=lambda vs: (vs[0], vs[0].raw.advance()))
 
     @staticmethod
     def LESS(lhs, rhs):
         t = Type.BOOL()
-        return Instruction("less", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw < vs[1].raw))
+        return Instruction("less", lhs, rhs, theType=t, transfer=lambda vs: Box(t, vs[0].raw < vs[1].raw),
+                           unboxed=operator.lt)
 
     @staticmethod
     def LOAD(name):
@@ -172,12 +190,13 @@ class Instruction:
 
     @staticmethod
     def NEW(valType):
-        return Instruction("new", theType=valType, transfer=lambda _:Box(valType))
+        return Instruction("new", theType=valType, transfer=lambda _:Box(valType, copy.copy(valType.zero)))
 
     @staticmethod
     def ORD_APPEND(ord, val):
         t = ord.type()
-        return Instruction("ord_append", ord, val, theType=t, transfer=lambda vs: Box(t, vs[0].raw + [val]))
+        return Instruction("ord_append", ord, val, theType=t, transfer=lambda vs: Box(t, vs[0].raw + [vs[1]]),
+                           inplace=list.append)
 
     @staticmethod
     def PHI(name, theType):
@@ -187,13 +206,15 @@ class Instruction:
     def RECORD_SET(record, name, value):
         t = record.type()
         return Instruction("record_set", record, value, name=name, theType=t,
-                           transfer=lambda vs: Box(t, dict([(k,v) for k,v in vs[0].raw.items() if k!=name] + [(name,vs[1])])))
+                           transfer=lambda vs: Box(t, dict([(k,v) for k,v in vs[0].raw.items() if k!=name] + [(name,vs[1])])),
+                           inplace=lambda raw, v: raw.__setitem__(name, v))
 
     @staticmethod
     def SET_INSERT(theSet, newElement):
         t = theSet.type()
         return Instruction("set_insert", theSet, newElement, theType=t,
-                           transfer=lambda vs: Box(t, vs[0].raw.union(set([vs[1]]))))
+                           transfer=lambda vs: Box(t, vs[0].raw.union(set([vs[1]]))),
+                           inplace=set.add)
 
     @staticmethod
     def STORE(value, name):
@@ -275,13 +296,18 @@ class Block:
         succ.preds.add(self)
 
 
-    def dotDecls(self, output):
+    def dotDecls(self, output, counts=None, peak=1):
+        '''With *counts* (from a Profile) the block is filled with a shade of red proportional to its execution
+           count relative to the *peak*, and each instruction is labelled with its count.'''
         print(f'subgraph cluster_bblock{self.label} {{', file=output)
         print(' color=grey;', file=output)
+        if counts is not None:
+            heat = counts.get(self, 0) / max(peak, 1)
+            print(f' style=filled; fillcolor="0.000 {heat:.3f} 1.000"; label="x{counts.get(self, 0)}";', file=output)
         print(f' bblock{self.label}_entry [shape=none, fontcolor="grey"];', file=output)
         print(f' bblock{self.label}_exit [shape=none, fontcolor="grey"];', file=output)
         for i in self.instructions:
-            i.dotNode(f'bblock{self.label}',output)
+            i.dotNode(f'bblock{self.label}', output, count=None if counts is None else counts.get(i, 0))
         print('}', file=output)
 
 
@@ -292,24 +318,24 @@ class Block:
             print(f' i{self.instructions[-1].label} -> bblock{self.label}_exit [color=none];', file=output)
 
 
-    def dump(self, done=None):
+    def dump(self, done=None, output=sys.stdout):
         if done is None:     done = set()
-        print(f'{self}:')
+        print(f'{self}:', file=output)
         for i, inst in enumerate(self.instructions):
-            print(f'  {self.label}_{i}: {inst}')
+            print(f'  {self.label}_{i}: {inst}', file=output)
         if self.trueSucc is None:
-            print(f'  Block exits function')
+            print(f'  Block exits function', file=output)
         else:
-            print(f'  True  -> {self.trueSucc}')
+            print(f'  True  -> {self.trueSucc}', file=output)
         if self.falseSucc is not None:
-            print(f'  False -> {self.falseSucc}')
+            print(f'  False -> {self.falseSucc}', file=output)
         for k,v in self.defs.items():
-            print(f'  def {k} <- {v}')
+            print(f'  def {k} <- {v}', file=output)
         done.add(self)
         if self.trueSucc is not None and self.trueSucc not in done:
-            self.trueSucc.dump(done=done)
+            self.trueSucc.dump(done=done, output=output)
         if self.falseSucc is not None and self.falseSucc not in done:
-            self.falseSucc.dump(done=done)
+            self.falseSucc.dump(done=done, output=output)
 
 
     def insert(self, instruction, pos=-1):
@@ -351,20 +377,25 @@ class Function:
         self.entry = entry
         self.name = None
 
-    def dump(self):
+    def dump(self, output=sys.stdout):
         name = 'outermost' if self.name is None else self.name
-        print(f'Function: {name}')
-        self.typeEnv.dump()
-        self.entry.dump()
+        print(f'Function: {name}', file=output)
+        self.typeEnv.dump(output=output)
+        self.entry.dump(output=output)
         for c in self.children.values():
-            c.dump()
+            c.dump(output=output)
         if '%return%' in self.entry.defs:
-            print(f'return {self.entry.defs["%return%"]}')
+            print(f'return {self.entry.defs["%return%"]}', file=output)
 
-    def dot(self, output):
+    def dot(self, output, counts=None):
+        '''Write the SSA graph for the function, *counts* maps Blocks and Instructions to execution counts to
+           colour the graph by hotness.'''
         print('digraph {', file=output)
+        peak = 1
+        if counts is not None:
+            peak = max([ counts.get(block, 0) for block in self.entry.reachable() ] + [1])
         for block in self.entry.reachable():
-            block.dotDecls(output)
+            block.dotDecls(output, counts, peak)
             if block.trueSucc is not None:
                 print(f' bblock{block.label}_exit -> bblock{block.trueSucc.label}_entry '
                        '[label="true",color="grey",fontcolor="grey"];', file=output)
@@ -0,0 +1,48 @@
+# Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
+#                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import json
+import sys
+
+# Diagnostics from the interpreter pipeline (translation, the SSA passes and execution) go through this module
+# instead of printing directly. Each level includes the ones before it:
+#   INFO    the start and end of execution
+#   DEBUG   translation, phi placement and elimination, builtins
+#   TRACE   every instruction executed
+# The levels are exposed as module flags so that a call site that is switched off costs an attribute load and a
+# branch, the message is only formatted behind the check:
+#     if log.debug:
+#         log.emit('phi.redundant', f'Eliminate redundant phi {inst}', phi=inst.label)
+# Emitted messages are written as text to *output* and/or as one JSON object per line to *events*.
+
+QUIET, INFO, DEBUG, TRACE = range(4)
+
+info, debug, trace = False, False, False
+output = sys.stdout
+events = None
+
+
+def configure(level=QUIET, text=sys.stdout, eventFile=None):
+    '''Switch on the messages up to *level*, written as text to *text* and as JSON lines to *eventFile* (either
+       can be None).'''
+    global info, debug, trace, output, events
+    info, debug, trace = level>=INFO, level>=DEBUG, level>=TRACE
+    output, events = text, eventFile
+
+
+def emit(event, message, **fields):
+    if output is not None:
+        print(message, file=output)
+    if events is not None:
+        record = { 'event':event, 'message':message }
+        record.update(fields)
+        print(json.dumps(record, default=str), file=events)
+
+
+def capture(dump):
+    '''Run a *dump* method that writes to an output file and return the text, so that dumps of environments
+       and functions can be emitted as a single message.'''
+    text = io.StringIO()
+    dump(output=text)
+    return text.getvalue().rstrip('\n')
@@ -0,0 +1,116 @@
+# Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
+#                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .box import Box
+from .irep import Block, Function, Instruction, Value
+
+# Every instruction in a function defines (at most) one SSA value, so numbering the instructions densely
+# in block order gives each value a slot in a flat list. Execution frames are preallocated lists of that
+# size and resolving an operand is a single index rather than a dictionary lookup keyed on Instruction.
+
+# The same numbering gives a compact serialised form of the function. Blocks are referred to by their
+# index in the numbering order and operands are encoded by their shape:
+#   * int               the value in that slot
+#   * (int,int)         output n of the multi-output instruction in that slot
+#   * Box               a constant
+#   * str               a named argument
+# An instruction is the tuple (op, operands, name, function, theType, position, source) and a block is
+# (instructions, trueSucc, falseSucc, return) where the successors are block indices or None.
+
+# The numbering order is a DFS preorder from the entry, so every block is numbered after the blocks
+# that dominate it: the only operands that refer forwards are the inputs to phi instructions.
+
+def numberSlots(func):
+    func.blocks = list(func.entry.reachable())
+    slot = 0
+    for index, block in enumerate(func.blocks):
+        block.index = index
+        for inst in block.instructions:
+            inst.slot = slot
+            slot += 1
+    func.slots = slot
+
+
+def encode(value):
+    if value.constant is not None:
+        return value.constant
+    if value.instruction is not None and value.output is not None:
+        return (value.instruction.slot, value.output)
+    if value.instruction is not None:
+        return value.instruction.slot
+    return value.argument
+
+
+def serialise(func):
+    numberSlots(func)
+    blocks = []
+    for block in func.blocks:
+        instructions = tuple( (inst.op, tuple(encode(v) for v in inst.values), inst.name, inst.function,
+                               inst.theType, inst.position, inst.source)
+                              for inst in block.instructions )
+        trueSucc  = None if block.trueSucc  is None else block.trueSucc.index
+        falseSucc = None if block.falseSucc is None else block.falseSucc.index
+        returned = encode(block.defs['%return%']) if '%return%' in block.defs else None
+        blocks.append( (instructions, trueSucc, falseSucc, returned) )
+    return tuple(blocks)
+
+
+# Rebuilding an instruction goes back through the constructor for the op so that the transfer function
+# is recreated, the operands are patched in afterwards to cover the forward references in phis.
+rebuild = {
+    'add':         lambda vs, name, function, theType, position: Instruction.ADD_NUMBER(vs[0], vs[1]),
+    'call':        lambda vs, name, function, theType, position: Instruction.CALL(function, theType, vs[0]),
+    'equal':       lambda vs, name, function, theType, position: Instruction.EQUAL(vs[0], vs[1]),
+    'great':       lambda vs, name, function, theType, position: Instruction.GREAT(vs[0], vs[1]),
+    'inequal':     lambda vs, name, function, theType, position: Instruction.INEQUAL(vs[0], vs[1]),
+    'iter_init':   lambda vs, name, function, theType, position: Instruction.ITER_INIT(vs[0]),
+    'iter_check':  lambda vs, name, function, theType, position: Instruction.ITER_CHECK(vs[0]),
+    'iter_access': lambda vs, name, function, theType, position: Instruction.ITER_ACCESS(vs[0]),
+    'less':        lambda vs, name, function, theType, position: Instruction.LESS(vs[0], vs[1]),
+    'load':        lambda vs, name, function, theType, position: Instruction.LOAD(name),
+    'new':         lambda vs, name, function, theType, position: Instruction.NEW(theType),
+    'ord_append':  lambda vs, name, function, theType, position: Instruction.ORD_APPEND(vs[0], vs[1]),
+    'phi':         lambda vs, name, function, theType, position: Instruction.PHI(name, theType),
+    'record_set':  lambda vs, name, function, theType, position: Instruction.RECORD_SET(vs[0], name, vs[1]),
+    'set_insert':  lambda vs, name, function, theType, position: Instruction.SET_INSERT(vs[0], vs[1]),
+    'store':       lambda vs, name, function, theType, position: Instruction.STORE(vs[0], name),
+    'tuple_set':   lambda vs, name, function, theType, position: Instruction.TUPLE_SET(vs[0], position, vs[1])
+}
+
+
+def deserialise(data, typeEnv):
+    '''Rebuild a Function from the output of serialise, running in the *typeEnv* that the original Function
+       was built in.'''
+    blocks = [ Block() for _ in data ]
+    slots = []
+
+    def decode(operand):
+        if isinstance(operand, Box):
+            return Value(constant=operand)
+        if isinstance(operand, str):
+            return Value(argument=operand)
+        slot, output = operand if isinstance(operand, tuple) else (operand, None)
+        if slot >= len(slots):
+            return None
+        return Value(instruction=slots[slot], output=output)
+
+    operands = []
+    for block, (instructions, trueSucc, falseSucc, returned) in zip(blocks, data):
+        for op, encoded, name, function, theType, position, source in instructions:
+            inst = rebuild[op](tuple(decode(o) for o in encoded), name, function, theType, position)
+            inst.source = source
+            block.insert(inst)
+            slots.append(inst)
+            operands.append(encoded)
+        if trueSucc is not None:
+            block.connect(True, blocks[trueSucc])
+        if falseSucc is not None:
+            block.connect(False, blocks[falseSucc])
+    for inst, encoded in zip(slots, operands):
+        inst.values = tuple(decode(o) for o in encoded)
+    for block, (_, _, _, returned) in zip(blocks, data):
+        if returned is not None:
+            block.defs['%return%'] = decode(returned)
+    result = Function(blocks[0], typeEnv)
+    numberSlots(result)
+    return result
@@ -1,6 +1,7 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from . import log
 from .irep import Value
 from ..util import MultiDict
 
@@ -37,7 +38,10 @@ def findReachingDefs(name, block, memo, argNames):
     if len(block.preds)==0 and name in argNames:
         return set([(None,None)])
     merged = set()
-    print(f'findReachingDef on blk{block.label} merging preds {[b.label for b in block.preds]}')
+    if log.trace:
+        preds = [b.label for b in block.preds]
+        log.emit('reachingdefs.merge', f'findReachingDef on blk{block.label} merging preds {preds}',
+                 block=block.label, name=name, preds=preds)
     for pred in block.preds:
         merged.update( findDef(name, pred, memo, argNames) )     # All loops are broken by at least one def
     return merged
@@ -46,10 +50,14 @@ def findDef(name, block, memo, argNames):
     if block in memo.map:    return memo.map[block]
     lastDef = block.lastDefinition(name)
     if lastDef is not None:
-        print(f'findDef on blk{block.label} found last def {lastDef}')
+        if log.trace:
+            log.emit('reachingdefs.found', f'findDef on blk{block.label} found last def {lastDef}', block=block.label,
+                     name=name)
         memo.store(block, (lastDef, block) )
         return memo.map[block]
-    print(f'blk{block.label} had no lastDef for {name} - searching')
+    if log.trace:
+        log.emit('reachingdefs.search', f'blk{block.label} had no lastDef for {name} - searching', block=block.label,
+                 name=name)
     incoming = findReachingDefs(name, block, memo, argNames)
     memo.update(block, incoming)
     return incoming
@@ -61,14 +69,17 @@ def calcReachingDefs(func):
     entry = func.entry
     argNames = [pair[0] for pair in funcArgs]
 
-    func.dump()
+    if log.debug:
+        log.emit('reachingdefs.function', log.capture(func.dump))
 
     for block in entry.reachable():
         for phi in block.instructions:
             if not phi.isPhi() or len(phi.values)>0:     continue
             if phi.name not in memoTables:  memoTables[phi.name] = MultiDict()
             defs = findReachingDefs(phi.name, block, memoTables[phi.name], argNames)
-            print(f'In blk{block.label}: {phi} updating with {defs}')
+            if log.debug:
+                log.emit('reachingdefs.phi', f'In blk{block.label}: {phi} updating with {defs}', block=block.label,
+                         name=phi.name)
             sources, phi.inputBlocks = zip(*defs)
             values = []
             for s in sources:
@@ -77,6 +88,7 @@ def calcReachingDefs(func):
                 else:
                     values.append(Value(instruction=s))
             phi.values = values
-    for name,memo in memoTables.items():
-        print(f'Final memo: {name} <- {memo}')
+    if log.trace:
+        for name,memo in memoTables.items():
+            log.emit('reachingdefs.memo', f'Final memo: {name} <- {memo}', name=name)
 
@@ -1,6 +1,7 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from . import log
 from .box import Box
 from .builtins import builtin_len, builtin_print
 from .frontend import AST
@@ -19,19 +20,28 @@ class BlockBuilder:
         self.entry   = self.current
         self.types   = types
         self.definitions = {}
+        self.source  = None
+
+
+    def insert(self, instruction):
+        '''Append the *instruction* to the current block, tagged with the source offset of the statement.'''
+        instruction.source = self.source
+        return self.current.insert(instruction)
 
 
     def fromScope(self, scope):
         if not isinstance(scope, tuple):
             scope = scope.children
         for stmt in scope:
-            print(f'Building {stmt}')
+            if log.debug:
+                log.emit('translate.statement', f'Building {stmt}', source=getattr(stmt, 'start', None))
+            self.source = getattr(stmt, 'start', None)
             if isinstance(stmt, AST.Assignment):
                 self.assignment(stmt)
             elif isinstance(stmt, AST.Return):
                 self.returnstmt(stmt)
             elif isinstance(stmt, AST.Call):
-                self.current.insert(Instruction.CALL( stmt.function, self.types.types[stmt.function].param2, self.expression(stmt.arg) ))
+                self.insert(Instruction.CALL( stmt.function, self.types.types[stmt.function].param2, self.expression(stmt.arg) ))
             elif type(stmt) in (AST.FunctionDecl, AST.EnumDecl, AST.TypeSynonym):
                 pass
             elif isinstance(stmt, AST.If):
@@ -73,30 +83,30 @@ class BlockBuilder:
                 val = self.expression(stmt.expr)
                 elemType = self.types.types[stmt.ident.span]
                 initIterator = Instruction.ITER_INIT(val)
-                self.current.insert(initIterator)
+                self.insert(initIterator)
                 itName = self.types.freshName(initIterator.theType)
-                self.current.insert(Instruction.STORE(Value(instruction=initIterator), itName))
+                self.insert(Instruction.STORE(Value(instruction=initIterator), itName))
 
                 headerBB = Block()
                 self.current.connect(True,headerBB)
                 self.current = headerBB
                 phi = Instruction.PHI(itName, theType=initIterator.theType)
-                self.current.insert(phi)
+                self.insert(phi)
                 inst = Instruction.ITER_CHECK(Value(instruction=phi))
-                self.current.insert(inst)
+                self.insert(inst)
 
                 mergeBB = Block()
                 self.current.connect(False,mergeBB)
                 bodyBB = Block()
                 self.current.connect(True,bodyBB)
                 self.current = bodyBB
-                access = self.current.insert(Instruction.ITER_ACCESS(Value(instruction=phi)))
+                access = self.insert(Instruction.ITER_ACCESS(Value(instruction=phi)))
                 newIt   = Value(instruction=access, output=0)
                 itValue = Value(instruction=access, output=1)
 
-                storeIt = self.current.insert(Instruction.STORE(itValue, stmt.ident.span))
+                storeIt = self.insert(Instruction.STORE(itValue, stmt.ident.span))
                 self.current.defs[stmt.ident.span] = Value(instruction=storeIt)
-                self.current.insert(Instruction.STORE(newIt, itName))
+                self.insert(Instruction.STORE(newIt, itName))
                 self.current.defs[newIt] = newIt
 
                 self.fromScope(stmt.scope)
@@ -109,23 +119,22 @@ class BlockBuilder:
 
 
     def assignment(self, stmt):
-        print(f'Building assign')
         value = self.expression(stmt.expr)
         self.current.defs[stmt.target] = value
-        self.current.insert( Instruction.STORE(value, stmt.target) )
+        self.insert( Instruction.STORE(value, stmt.target) )
 
 
     def condition(self, condition):
         lhs = self.expression(condition.children[0])
         rhs = self.expression(condition.children[2])
         if condition.children[1].span=='<':
-            return self.current.insert( Instruction.LESS(lhs,rhs) )
+            return self.insert( Instruction.LESS(lhs,rhs) )
         if condition.children[1].span=='>':
-            return self.current.insert( Instruction.GREAT(lhs,rhs) )
+            return self.insert( Instruction.GREAT(lhs,rhs) )
         if condition.children[1].span=='==':
-            return self.current.insert( Instruction.EQUAL(lhs,rhs) )
+            return self.insert( Instruction.EQUAL(lhs,rhs) )
         if condition.children[1].span=='!=':
-            return self.current.insert( Instruction.INEQUAL(lhs,rhs) )
+            return self.insert( Instruction.INEQUAL(lhs,rhs) )
         assert False, f'Unknown conditional in translation {self.children[1].span}'
 
     def expression(self, expr):
@@ -136,7 +145,8 @@ class BlockBuilder:
             return Value(constant=Box(Type.STRING(), expr.content))
 
         if isinstance(expr, AST.Ident):
-            print(f'Building expression/Ident {expr.span}')
+            if log.trace:
+                log.emit('translate.ident', f'Building expression/Ident {expr.span}', name=expr.span)
             if expr.span=="true":
                 return Value(constant=Box(Type.BOOL(), True))
             if expr.span=="false":
@@ -148,7 +158,7 @@ class BlockBuilder:
                 return self.current.defs[expr.span]
             assert exprType is not None
             inst = Instruction.PHI(expr.span, exprType)
-            self.current.insert(inst)
+            self.insert(inst)
             value = Value(instruction=inst)
             self.current.defs[expr.span] = value
             return value
@@ -159,12 +169,12 @@ class BlockBuilder:
                 op = opChild.children[0].span
                 rhs = self.expression(opChild.children[1])
                 # lhs and rhs are now values, how do we extract the type?
-                print(lhs, type(lhs))
-                print(rhs)
+                if log.trace:
+                    log.emit('translate.binop', f'Building {op} on {lhs} {rhs}', op=op)
                 if lhs.type().isNumber() and rhs.type().isNumber():
                 #if self.types.instructions[lhs].isNumber() and self.types.instructions[rhs].isNumber():
                     inst = Instruction.ADD_NUMBER(lhs,rhs)
-                    self.current.insert(inst)
+                    self.insert(inst)
                 else:
                     assert False, f'Unknown types for add operation'
                 lhs = inst
@@ -172,7 +182,7 @@ class BlockBuilder:
 
         if isinstance(expr, AST.Call):
             inst = Instruction.CALL( expr.function, self.types.types[expr.function].param2, self.expression(expr.arg) )
-            self.current.insert(inst)
+            self.insert(inst)
             return Value(instruction=inst)
 
         if isinstance(expr, AST.Record):
@@ -187,28 +197,29 @@ class BlockBuilder:
         assert False, f'Cannot translate unexpected expression node {expr}'
 
     def order(self, theOrd):
-        print(f'New order: {self.types.expressions[theOrd]}')
+        if log.trace:
+            log.emit('translate.order', f'New order: {self.types.expressions[theOrd]}')
         s = Instruction.NEW(self.types.expressions[theOrd])
-        self.current.insert(s)
+        self.insert(s)
         for valueAST in theOrd.seq:
-            s = Instruction.ORD_APPEND(s, self.expression(valueAST))
-            self.current.insert(s)
-        return s
+            s = Instruction.ORD_APPEND(Value(instruction=s), self.expression(valueAST))
+            self.insert(s)
+        return Value(instruction=s)
 
 
     def record(self, rec):
         recType = self.types.expressions[rec]
         r = Instruction.NEW(recType)
-        self.current.insert(r)
+        self.insert(r)
         if recType.isRecord():
             for name, valueAST in rec.record.items():
                 r = Instruction.RECORD_SET(Value(instruction=r), name, self.expression(valueAST))
-                self.current.insert(r)
+                self.insert(r)
             return Value(instruction=r)
         if recType.isTuple():
             for pos, identVal in enumerate(rec.children):
                 r = Instruction.TUPLE_SET(Value(instruction=r), pos, self.expression(identVal.value))
-                self.current.insert(r)
+                self.insert(r)
             return Value(instruction=r)
         assert False, f'AST.Record must describe either a named-record or a tuple'
 
@@ -217,10 +228,10 @@ class BlockBuilder:
 
     def set(self, theSet):
         s = Instruction.NEW(self.types.expressions[theSet])
-        self.current.insert(s)
+        self.insert(s)
         for valueAST in theSet.elements:
             s = Instruction.SET_INSERT(Value(instruction=s), self.expression(valueAST))
-            self.current.insert(s)
+            self.insert(s)
         return Value(instruction=s)
 
 
@@ -2,7 +2,9 @@
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import functools
+import sys
 
+from . import log
 from .box import Box
 from .frontend import AST
 from .types import Type, TypesCannotJoin
@@ -14,6 +16,10 @@ class TypingFailed(Exception):
         self.tree = tree
         super().__init__(msg)
 
+    def location(self, lines):
+        '''Describe where the failing tree starts in the input indexed by *lines*.'''
+        return lines.describe(getattr(self.tree, 'start', None))
+
 
 class TypedEnvironment:
     def __init__(self):
@@ -24,14 +30,14 @@ class TypedEnvironment:
         self.freshCounter = 0
 
 
-    def dump(self):
-        print('TypedEnv:')
+    def dump(self, output=sys.stdout):
+        print('TypedEnv:', file=output)
         for name,namedType in self.types.items():
             if name in self.values:
                 withVal = f' = {self.values[name]}'
             else:
                 withVal = ''
-            print(f'  {name} :: {namedType}{withVal}')
+            print(f'  {name} :: {namedType}{withVal}', file=output)
 
 
     def wipe(self):
@@ -210,7 +216,8 @@ class TypedEnvironment:
         if tree.span in ('true','false'):
             return Type.BOOL()
         if not tree.span in self.types:
-            self.dump()
+            if log.debug:
+                log.emit('typecheck.env', log.capture(self.dump))
             raise TypingFailed(tree, f"Cannot infer type of {tree.span}")
         return self.types[tree.span]
 
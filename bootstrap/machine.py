@@ -160,6 +160,75 @@ class AState:
         return self.label
 
 
+class Lookahead:
+    '''The characters that can start a step out of an AState. A step that does not consume input (glue
+       or remover) moves to another AState at the same position, so the characters admitted by that state
+       are included under the special symbol that was passed last: after glue the next character is read
+       directly, after remover the discard channel is processed first, and with no special symbol it depends
+       on the glue-state of the PState. A reduction continues in one of the AStates reached by accepting the
+       lhs, so their characters are included as the follow-set, and the reduction of the entry rule admits
+       the end of the input.'''
+    modes = (None, 'glue', 'remover')
+
+    def __init__(self):
+        self.open       = False
+        self.chars      = { m:set() for m in Lookahead.modes }
+        self.excluded   = { m:set() for m in Lookahead.modes }
+        self.end        = { m:False for m in Lookahead.modes }
+        self.reductions = set()
+
+    def add(self, mode, eqClass):
+        if isinstance(eqClass, SymbolTable.TermStringEQ):
+            if len(eqClass.literal)==0:
+                self.open = True
+            else:
+                self.chars[mode].add(eqClass.literal[0])
+        elif eqClass.inverse:
+            self.excluded[mode].add(eqClass.chars)
+        else:
+            self.chars[mode].update(eqClass.chars)
+
+    def merge(self, mode, other):
+        '''Include the *other* Lookahead reached after passing the special symbol *mode*, return True if
+           this Lookahead has grown.'''
+        before = self.sig()
+        self.open = self.open or other.open
+        for otherMode in Lookahead.modes:
+            target = mode if otherMode is None else otherMode
+            self.chars[target].update(other.chars[otherMode])
+            self.excluded[target].update(other.excluded[otherMode])
+            self.end[target] = self.end[target] or other.end[otherMode]
+        return self.sig()!=before
+
+    def sig(self):
+        return (self.open,) + tuple( (len(self.chars[m]),len(self.excluded[m]),self.end[m]) for m in Lookahead.modes )
+
+    def matches(self, mode, char):
+        return char in self.chars[mode] or any(char not in excluded for excluded in self.excluded[mode])
+
+    def admits(self, input, position, keep, processDiscard):
+        '''Check if the character at *position* (after the discard channel when it is active) can start a
+           step from the AState.'''
+        if self.open:
+            return True
+        discarded = None
+        for mode in Lookahead.modes:
+            if len(self.chars[mode])==0 and len(self.excluded[mode])==0 and not self.end[mode]:
+                continue
+            if mode=='glue' or (mode is None and keep):
+                next = position
+            else:
+                if discarded is None:
+                    discarded = position + processDiscard(input[position:])
+                next = discarded
+            if next==len(input):
+                if self.end[mode]:
+                    return True
+            elif self.matches(mode, input[next]):
+                return True
+        return False
+
+
 class Handle:
     def __init__(self, config):
         '''Build a restricted NFA for recognising the configuration - no loops larger than self-loops, no choices.
@@ -463,6 +532,51 @@ class Automaton:
 
         self.states = worklist.set
         assert isinstance(self.states, dict)
+        self.calculateLookaheads()
+
+
+    def calculateLookaheads(self):
+        '''Attach a Lookahead to every AState. The terminals are collected by following chains of glue /
+           remover edges to the states that consume input, then the follow-sets of reductions are iterated
+           to a fixed-point.'''
+        gotos = MultiDict()
+        for state in self.states:
+            for eqClass, target in state.edges[0].items():
+                if isinstance(eqClass, SymbolTable.NonterminalEQ):
+                    gotos.store(eqClass, target)
+
+        for state in self.states:
+            lookahead = Lookahead()
+            marked = set()
+            todo = [(None,state)]
+            while len(todo)>0:
+                mode, current = todo.pop()
+                if (mode,current) in marked:
+                    continue
+                marked.add((mode,current))
+                for priLevel in current.edges:
+                    for edgeLabel, target in priLevel.items():
+                        if isinstance(edgeLabel, Automaton.Configuration):
+                            lookahead.reductions.add((mode,edgeLabel.lhs))
+                        elif isinstance(edgeLabel, SymbolTable.SpecialEQ):
+                            todo.append((edgeLabel.name,target))
+                        elif edgeLabel.isTerminal:
+                            lookahead.add(mode, edgeLabel)
+            state.lookahead = lookahead
+
+        changed = True
+        while changed:
+            changed = False
+            for state in self.states:
+                for mode, lhs in state.lookahead.reductions:
+                    if lhs is None:
+                        if not state.lookahead.end[mode]:
+                            state.lookahead.end[mode] = True
+                            changed = True
+                        continue
+                    for target in gotos.map.get(lhs, ()):
+                        if state.lookahead.merge(mode, target.lookahead):
+                            changed = True
 
     def dot(self, output):
         def makeNextId(state, next, symbol, output):
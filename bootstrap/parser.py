@@ -1,9 +1,9 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import html
+import heapq, html, itertools, sys
 from .machine import SymbolTable, Automaton, Handle, AState, Symbol
-from .util import MultiDict, OrdSet, strs, dump
+from .util import LineIndex, LRUDict, MultiDict, OrdSet, strs, dump
 
 class Barrier:
     counter = 1
@@ -51,16 +51,30 @@ class Barrier:
 
 
     def remove(self, state):
-        self.states.remove(state)
+        # A latched barrier can be cancelled by a result while a nested barrier is still running
+        self.states.discard(state)
+
+
+    def latch(self, levels):
+        '''The only live state in the barrier has split into prioritised *levels*. Rather than nesting a new
+           barrier inside this one, the lower-priority levels are prepended to the continuation: they run
+           before any of the existing continuation and after the states in the first level have completed,
+           which is the same order that the nested barrier would produce. The states in the delayed levels
+           were registered here when they were built, but they belong to the enclosing barrier now.'''
+        for level in levels:
+            for state in level:
+                self.states.discard(state)
+                state.barrier = self.parent
+        self.continuation = levels + self.continuation
 
 
-# Note: there is no latching of states in this implementation. It is not needed for functional correctness,
-#       but will be added later as it will reduce the number of barriers in the trace.
 class PState:
     counter = 1
     '''A state of the parser (i.e. a stack and input position). In a conventional GLR parser this would
        just be the stack, but we are building a fused lexer/parser that operates on a stream of characters
        instead of terminals.'''
+    repairs = ()
+    cost    = 0
     def __init__(self, stack, position, processDiscard, keep=False, label="", barrier=None):
         self.stack          = stack
         self.position       = position
@@ -75,11 +89,12 @@ class PState:
 
 
     def __hash__(self):
-        return hash((tuple(self.stack),self.position))
+        return hash((tuple(self.stack),self.position,self.keep))
 
 
     def __eq__(self, other):
-        return isinstance(other,PState) and self.stack==other.stack and self.position==other.position
+        return isinstance(other,PState) and self.stack==other.stack and self.position==other.position \
+                                        and self.keep==other.keep
 
 
     def enter(self, barrier):
@@ -100,7 +115,30 @@ class PState:
         return None, None
 
 
-    def successors(self, input):
+    def latched(self):
+        '''A state is latched when it is the only live state in its barrier: the future of the barrier is
+           decided by this state alone so any split in priority can reuse the barrier instead of nesting.'''
+        return self.barrier is not None and len(self.barrier.states)==1 and self in self.barrier.states
+
+
+    def successors(self, input, pruning=False, cache=None, blocked=None):
+        '''Calculate the successor states of this PState, grouped into priority levels. When *pruning* is
+           enabled any successor whose AState cannot accept the next input character is dropped before it
+           is built. When a *cache* is supplied the Tokens for recognised spans are shared between stacks.
+           When *blocked* is supplied each dropped successor is built outside of any barrier and appended to
+           it instead, as that is where the stack would have blocked and where error recovery repairs from.'''
+        def admits(target, position, keep, stack):
+            if not pruning or target.lookahead.admits(input, position, keep, self.processDiscard):
+                return True
+            if blocked is not None:
+                dropped = PState(stack(), position, self.processDiscard, keep, "pruned")
+                dropped.repairs, dropped.cost = self.repairs, self.cost
+                blocked.append(dropped)
+            return False
+
+        def splice(token):
+            return token if cache is None else cache.splice(token)
+
         result = []
         astate = self.stack[-1]
         remaining = self.position
@@ -125,43 +163,57 @@ class PState:
                             result[-1].append(PState(newStack, self.position, self.processDiscard,
                                                      self.keep, "reduce", self.barrier))
                             continue
-                        newStack.append( Token(target.lhs,handle,None) )
+                        start = handle[0].start if len(handle)>0 else self.position
+                        newStack.append( Token(target.lhs,handle,None,start,self.position) )
                         returnState = newStack[-2]
                         # When there is a merge in the automaton with identical edges coming into the same
                         # state from distinct prior states, handle checking must only follow the valid path
                         # in reverse.
                         if target.lhs in returnState.edges[0]:
-                            newStack.append(returnState.edges[0][edgeLabel.lhs])
+                            gotoState = returnState.edges[0][edgeLabel.lhs]
+                            if not admits(gotoState, self.position, self.keep, lambda: newStack + [gotoState]):
+                                continue
+                            # Only reductions that survive pruning are shared through the cache
+                            newStack[-1] = splice(newStack[-1])
+                            newStack.append(gotoState)
                             result[-1].append( PState(newStack, self.position, self.processDiscard, self.keep,
                                                       "reduce", self.barrier))
                 elif isinstance(edgeLabel, SymbolTable.SpecialEQ) and edgeLabel.name=="glue":
-                    result[-1].append( PState(self.stack[:-1] + [target], self.position,
-                                              self.processDiscard, True, "shift", self.barrier))
+                    if admits(target, self.position, True, lambda: self.stack[:-1] + [target]):
+                        result[-1].append( PState(self.stack[:-1] + [target], self.position,
+                                                  self.processDiscard, True, "shift", self.barrier))
                 elif isinstance(edgeLabel, SymbolTable.SpecialEQ) and edgeLabel.name=="remover":
-                    result[-1].append( PState(self.stack[:-1] + [target], remaining,
-                                              self.processDiscard, False, "shift", self.barrier))
+                    if admits(target, remaining, False, lambda: self.stack[:-1] + [target]):
+                        result[-1].append( PState(self.stack[:-1] + [target], remaining,
+                                                  self.processDiscard, False, "shift", self.barrier))
                 else:
                     assert type(edgeLabel) in (SymbolTable.TermSetEQ,
                                                SymbolTable.TermStringEQ,
                                                SymbolTable.NonterminalEQ), type(edgeLabel)
                     matched = edgeLabel.matchInput(input[remaining:])
-                    if matched is not None:
-                        result[-1].append( PState(self.stack + [Token(edgeLabel,(),matched),target],
+                    if matched is not None and \
+                       admits(target, remaining+len(matched), self.keep,
+                              lambda: self.stack + [Token(edgeLabel,(),matched,remaining,remaining+len(matched)),
+                                                    target]):
+                        token = splice(Token(edgeLabel,(),matched,remaining,remaining+len(matched)))
+                        result[-1].append( PState(self.stack + [token,target],
                                                   remaining+len(matched), self.processDiscard, self.keep,
                                                   "shift", self.barrier))
         return [ p for p in result if len(p)>0 ]
 
 
-    def dotLabel(self, input, redundant):
+    def dotLabel(self, input, redundant, lines):
         remaining = input[self.position:]
         astate = self.stack[-1]
         cell = ' bgcolor="#ffdddd"' if redundant else ''
         if not isinstance(astate,AState):
             return "<Terminated>"
+        line, column = lines.location(self.position)
+        result =  f'< <table border="0"><tr><td{cell}><font color="grey">{line}:{column}</font> '
         if len(remaining)>30:
-            result =  f'< <table border="0"><tr><td{cell}>{html.escape(remaining[:30])}...</td></tr><hr/>'
+            result += f'{html.escape(remaining[:30])}...</td></tr><hr/>'
         else:
-            result =  f'< <table border="0"><tr><td{cell}>{html.escape(remaining)}</td></tr><hr/>'
+            result += f'{html.escape(remaining)}</td></tr><hr/>'
 
         stackStrs = []
         for s in self.stack[-8:]:
@@ -174,7 +226,7 @@ class PState:
 
 
 class Token:
-    def __init__(self, symbol, children, span):
+    def __init__(self, symbol, children, span, start=None, end=None):
         self.symbol   = symbol
         if hasattr(symbol,'tag'):
             self.tag = symbol.tag
@@ -186,6 +238,8 @@ class Token:
                f'{symbol} is {repr(symbol)}'
         self.children = children
         self.span     = span
+        self.start    = start
+        self.end      = end
         for c in children:
             assert isinstance(c, Token), c
 
@@ -193,6 +247,8 @@ class Token:
     def __str__(self):
         if self.symbol is not None and self.symbol.isTerminal:
             return f'T({self.span})'
+        if self.symbol is Recovery.symbol:
+            return f'E({repr(self.span)})'
         return f'N({self.symbol.name})'
 
 
@@ -211,49 +267,213 @@ class Token:
         return self.children[idx].span==span
 
 
+    def damaged(self):
+        '''Is there an error Token from recovery in this tree?'''
+        return any( isinstance(c,Token) and (c.symbol is Recovery.symbol or c.damaged()) for c in self.children )
+
+
+    def insertInto(self, node):
+        '''Place this error Token in the tree under *node*, beneath the deepest nonterminal that covers its span
+           and in order with the siblings there. Tokens may be shared between trees so the path down to the
+           insertion point is copied, the new root is returned.'''
+        children = list(node.children)
+        for i,c in enumerate(children):
+            if isinstance(c,Token) and c.symbol.isNonterminal and c.symbol is not Recovery.symbol and \
+               c.start is not None and c.start<c.end and c.start<=self.start and self.end<=c.end:
+                children[i] = self.insertInto(c)
+                break
+        else:
+            idx = len([ c for c in children if isinstance(c,Token) and c.start is not None and c.start<self.start ])
+            children.insert(idx, self)
+        start = self.start if node.start is None else min(node.start, self.start)
+        end   = self.end   if node.end   is None else max(node.end,   self.end)
+        return Token(node.symbol, tuple(children), node.span, start, end)
+
+
+class Recovery:
+    '''Configuration of the repair search for error recovery. A repair of a blocked PState pops tokens off the
+       stack and then skips characters in the input, costing *popCost* for each token and *skipCost* for each
+       character. Repairs are bounded by *maxCost* in total along a parse, and the search will run at most
+       *attempts* repaired states forward before giving up. The popped tokens and skipped text are recorded in
+       an error Token with the symbol Recovery.symbol.'''
+    symbol = SymbolTable.NonterminalEQ('%error%')
+
+    def __init__(self, maxCost=8, attempts=1024, popCost=1, skipCost=1):
+        self.maxCost  = maxCost
+        self.attempts = attempts
+        self.popCost  = popCost
+        self.skipCost = skipCost
+
+
+    def repairs(self, state, input):
+        '''Generate the repaired PStates for a blocked *state* within the remaining cost.'''
+        position = state.position
+        if not state.keep:
+            position += state.processDiscard(input[position:])
+        stack = state.stack
+        maxPops = (len(stack)-1)//2 if isinstance(stack[-1],AState) else 0
+        for pops in range(maxPops+1):
+            popped = stack[len(stack)-2*pops:]
+            base = state.cost + pops*self.popCost
+            for skip in range(len(input)-position+1):
+                cost = base + skip*self.skipCost
+                if cost>self.maxCost:
+                    break
+                if cost==state.cost:
+                    continue
+                tokens = tuple( t for t in popped if isinstance(t,Token) )
+                start = tokens[0].start if len(tokens)>0 else position
+                error = Token(Recovery.symbol, tokens, input[position:position+skip], start, position+skip)
+                repaired = PState(stack[:len(stack)-2*pops], position+skip, state.processDiscard, state.keep,
+                                  "repair")
+                repaired.repairs = state.repairs + (error,)
+                repaired.cost    = cost
+                yield repaired
+
+
+class TokenCache:
+    '''A cache that shares the Token built for each recognised span between stacks. The table is keyed by
+       (symbol, start position) and records the Token built for each end position. When another stack finishes
+       recognising the same symbol over the same span the recorded Token is spliced in, so the stacks become
+       identical from that point and the parser only continues one of them. This is not packrat memoisation:
+       in the LR automaton the descent into a nonterminal is spread over shifts shared with other items, so a
+       stack still re-recognises the span before the cache is consulted, only the work after the span is
+       saved. Like a packrat parser it commits to the first derivation of each span: ambiguous parses inside
+       a span are collapsed to a single tree. The table is bounded to *capacity* keys by evicting the
+       least-recently used, an evicted span is simply not shared.'''
+    def __init__(self, capacity=4096):
+        self.table  = LRUDict(capacity)
+        self.hits   = 0
+        self.misses = 0
+
+
+    def reset(self):
+        '''Forget the spans of the previous input, the hit and miss counts accumulate across inputs.'''
+        self.table = LRUDict(self.table.capacity)
+
+
+    def report(self, file=sys.stdout):
+        print(f'token cache: {self.hits} hits, {self.misses} misses', file=file)
+
+
+    def splice(self, token):
+        key = (token.symbol, token.start)
+        spans = self.table.get(key)
+        if spans is None:
+            spans = {}
+            self.table.store(key, spans)
+        if token.end in spans:
+            self.hits += 1
+            return spans[token.end]
+        self.misses += 1
+        spans[token.end] = token
+        return token
+
+
 class Parser:
-    def __init__(self, machine, ntTransformer={}, tTransformer={}):
+    def __init__(self, machine, ntTransformer={}, tTransformer={}, latching=True, pruning=True, cache=None):
         self.machine = machine
         self.tTransformer  = tTransformer
         self.ntTransformer  = ntTransformer
-
-    def execute(self, input, tracing=False):
+        self.latching       = latching
+        self.pruning        = pruning
+        self.cache          = cache
+        self.peak           = 0
+
+    def duplicate(self, state, seen):
+        '''With a cache the stacks that recognise the same spans share Tokens, so a PState equal to one already
+           scheduled in the same barrier has the same future and can be dropped. The barrier holds equal
+           states as a single member so there is nothing to remove from it.'''
+        if self.cache is None:
+            return False
+        key = (state, state.barrier)
+        if key in seen:
+            return True
+        seen.add(key)
+        return False
+
+    def execute(self, input, tracing=False, recovery=None):
+        '''Parse the *input* and yield each result tree. When no parse is found and a *recovery* configuration
+           is supplied the configurations where the parser blocked are repaired by popping tokens off the stack
+           and skipping characters in the input, the cheapest repaired parses are yielded with error nodes in
+           place of the popped tokens and skipped text. The error nodes of each yielded tree are kept as a tuple
+           in self.errors, in the same order as the trees (empty for a tree that needed no repair). The largest
+           number of live PStates in a step is recorded in self.peak.'''
         self.trace = Trace(input, tracing)
-        pstates = [PState([self.machine.start], 0, self.machine.processDiscard)]
+        self.lines = self.trace.lines
+        self.errors = []
+        self.peak = 0
+        if self.cache is not None:
+            self.cache.reset()
+        blocked = [] if recovery is not None else None
+        initial = PState([self.machine.start], 0, self.machine.processDiscard)
+        found = False
+        for p in self.run(input, [initial], blocked):
+            found = True
+            self.errors.append(())
+            yield self.prune(p.stack[1])
+        if not found and recovery is not None:
+            yield from self.recover(input, blocked, recovery)
+
+
+    def run(self, input, pstates, blocked=None):
+        '''Step the *pstates* through the input and yield each terminated PState that accepts the input. Any
+           state that blocks is appended to *blocked* when it is supplied, including the successors that pruning
+           drops, so that recovery sees the states that reached the furthest into the input.'''
+        pruning = self.pruning
+        emitted = set()
         while len(pstates)>0:
+            self.peak = max(self.peak, len(pstates))
             next = []
+            seen = set()
             for p in pstates:
                 #print(f'Execute p{p.id} {strs(p.stack)}')
                 self.trace.barrier(p)
                 if not isinstance(p.stack[-1],AState):
                     remaining = p.position + self.machine.processDiscard(input[p.position:])
                     if remaining==len(input) and len(p.stack)==2:
-                        yield self.prune(p.stack[1])
+                        # With a cache distinct stacks can finish on the same shared tree
+                        if self.cache is None or p.stack[1] not in emitted:
+                            emitted.add(p.stack[1])
+                            yield p
                         p.cancel()
                         self.trace.result(p)
                         continue
                     else:
                         self.trace.blocks(p)
+                        if blocked is not None:
+                            blocked.append(p)
                         # Fall-through to completion
                 else:
                     #try:
-                    succ = p.successors(input)
+                    latched = self.latching and p.latched()
+                    succ = p.successors(input, pruning, self.cache, blocked)
                     #print(f'succ {[[st.id for st in pri] for pri in succ]}')
                     if len(succ)==0:
                         self.trace.blocks(p)
+                        if blocked is not None:
+                            blocked.append(p)
                     else:
+                        if p.cost>0:
+                            for level in succ:
+                                for state in level:
+                                    state.repairs, state.cost = p.repairs, p.cost
                         barrier = None
-                        if len(succ)>1:
+                        if len(succ)>1 and latched:
+                            p.barrier.latch(succ[1:])
+                        elif len(succ)>1:
                             barrier = Barrier(succ[1:], parent=p.barrier)
                             #print(f'p{p.id} creates b{barrier.id}: {barrier}')
 
                         for state in succ[0]:
+                            state.enter(barrier)
+                            if self.duplicate(state, seen):
+                                continue
                             if state.label=="shift":
                                 self.trace.shift(p,state)
                             else:
                                 self.trace.reduce(p,state)
                             next.append(state)
-                            state.enter(barrier)
                     #except AssertionError as e:
                     #    self.trace.blocks(p)
                     #    print(f'ERROR {e}')
@@ -264,33 +484,71 @@ class Parser:
                         barrier = Barrier(continuation[1:], closedBarrier.parent)
 
                     for state in continuation[0]:
+                        state.enter(barrier)
+                        if self.duplicate(state, seen):
+                            continue
                         if state.label=="shift":
                             self.trace.shift(closedBarrier, state)
                         else:
                             self.trace.reduce(closedBarrier, state)
                         next.append(state)
-                        state.enter(barrier)
 
             #print(f'next {[st.id for st in next]}')
             pstates = next
 
-    def prune(self, node):
+
+    def recover(self, input, blocked, recovery):
+        '''Search the repairs of the *blocked* states in order of cost. Each repair is run forward on its own and
+           any states that block again are repaired in turn with the accumulated cost. Every parse found at the
+           cheapest cost that succeeds is yielded, the search gives up when the *recovery* budget runs out.'''
+        queue, order = [], itertools.count()
+        def push(states):
+            for b in states:
+                for repaired in recovery.repairs(b, input):
+                    self.trace.repair(b, repaired)
+                    heapq.heappush(queue, (repaired.cost, -repaired.position, next(order), repaired))
+        push(blocked)
+        attempts, found, done = 0, None, set()
+        while len(queue)>0 and attempts<recovery.attempts:
+            cost, _, _, state = heapq.heappop(queue)
+            if found is not None and cost>found:
+                break
+            if state in done:
+                continue
+            done.add(state)
+            attempts += 1
+            blocked = []
+            for p in self.run(input, [state], blocked):
+                found = cost
+                self.errors.append(p.repairs)
+                root = p.stack[1]
+                for error in p.repairs:
+                    root = error.insertInto(root)
+                yield self.prune(root, repaired=True)
+            if found is None:
+                push(blocked)
+
+    def prune(self, node, repaired=False):
+        '''Collapse the chains of single children and apply the transformers bottom-up. In a *repaired* tree a
+           node with an error Token beneath it is left as a raw Token, as the transformers expect the shape of
+           a valid parse.'''
         if not isinstance(node,Token):      return node
         if node.symbol.isNonterminal:
-            if len(node.children)==1:
-                pruned = self.prune(node.children[0])
+            if len(node.children)==1 and node.symbol is not Recovery.symbol:
+                pruned = self.prune(node.children[0], repaired)
             else:
-                result = [ self.prune(c) for c in node.children]
+                result = [ self.prune(c, repaired) for c in node.children]
                 node.children = tuple(result)
                 pruned = node
         else:
             pruned = node
         if not isinstance(pruned,Token):    return pruned
+        if repaired and pruned.damaged():   return pruned
         try:
             if pruned.symbol.isNonterminal and pruned.symbol.name in self.ntTransformer:
-                return self.ntTransformer[pruned.symbol.name](pruned)
+                return self.locate(self.ntTransformer[pruned.symbol.name](pruned), pruned)
             if pruned.symbol.isTerminal and pruned.tag in self.tTransformer:
-                return self.tTransformer[pruned.tag](pruned)
+                return self.locate(self.tTransformer[pruned.tag](pruned), pruned)
         except:
             print(f'Failed to apply transformer to:')
             dump(pruned)
@@ -300,10 +558,19 @@ class Parser:
 
 
 
+    def locate(self, result, token):
+        '''Copy the offsets of the *token* onto the object that a transformer built from it, unless the object
+           already carries its own (e.g. a child that was passed through).'''
+        if hasattr(result,'__dict__') and getattr(result,'start',None) is None:
+            result.start, result.end = token.start, token.end
+        return result
+
+
 class Trace:
     def __init__(self, input, recording):
         self.recording = recording
         self.input     = input
+        self.lines     = LineIndex(input)
         self.forwards  = MultiDict()
         self.backwards = MultiDict()
         self.redundant = None
@@ -322,6 +589,13 @@ class Trace:
         self.forwards.store(source,  (destination, 'reduce'))
         self.backwards.store(destination, (source, 'reduce'))
 
+    def repair(self, source, destination):
+        if not self.recording: return
+        assert source is not None
+        assert destination is not None
+        self.forwards.store(source,  (destination, 'repair'))
+        self.backwards.store(destination, (source, 'repair'))
+
     def result(self, state):
         if not self.recording: return
         assert state is not None
@@ -350,7 +624,7 @@ class Trace:
         for n in nodes:
             if isinstance(n, PState):
                 print(f'p{n.id} [shape=none, ' +
-                      f'label={n.dotLabel(self.input,self.redundant.get(n,True))}];', file=target)
+                      f'label={n.dotLabel(self.input,self.redundant.get(n,True),self.lines)}];', file=target)
             elif isinstance(n, Barrier):
                 print(f'b{n.id} [shape=none, fontcolor=orange, label="Barrier {n.id}"];', file=target)
                 if n.parent is not None:
@@ -377,14 +651,16 @@ class Trace:
         self.redundant = {}
         for k in self.forwards.map.keys():
             self.redundant[k] = True
-        # The backwards map over the trace is acyclic and performance is not a concern
+        # The backwards map over the trace is acyclic, but a latched barrier is shared by many states so the
+        # number of paths back to the start can explode: ancestors of a marked node are already marked.
         def markAncestors(state):
             if not state in self.backwards.map:
                 pass #print(f'Orphan {state}')
             else:
                 for next,_ in self.backwards.map[state]:
-                    self.redundant[next] = False
-                    markAncestors(next)
+                    if self.redundant.get(next,True):
+                        self.redundant[next] = False
+                        markAncestors(next)
         if True in self.backwards.map:
             for s,_ in self.backwards.map[True]:
                 markAncestors(s)
@@ -394,6 +670,11 @@ class Trace:
         redundant = self.redundant.values()
         return len([v for v in redundant if v]) / len(redundant)
 
+    def size(self):
+        '''Return the number of PStates and Barriers recorded in the trace.'''
+        nodes = set(self.forwards.map.keys()) | set(self.backwards.map.keys())
+        return len([n for n in nodes if isinstance(n,PState)]), len([n for n in nodes if isinstance(n,Barrier)])
+
     def solutions(self):
         if True in self.backwards.map:
             for s,_ in self.backwards.map[True]:
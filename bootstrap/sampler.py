@@ -7,14 +7,20 @@ if rootDir not in sys.path:
     sys.path.append(rootDir)
 
 import argparse
+import bisect
+import collections
+import hashlib
 import itertools
 import math
+import multiprocessing
 import operator
+import pickle
 import random
 import string
+import time
 from bootstrap.grammar import Grammar
 from bootstrap.interpreter import buildCommon, stage2
-from bootstrap.util import strs
+from bootstrap.util import LRUDict, strs
 
 
 def ordered_partitions_n(total, length):
@@ -88,11 +94,30 @@ class ClauseAllocation:
         for i in range(len(self.nonterms)):
             yield (assignment[self.posNonterms+i], self.nonterms[i][1])
 
-def weighted_choice(keys_weights):
+class WeightTable:
+    '''The cumulative weights of a choice so that repeated draws from the same distribution cost a binary
+       search instead of a scan over the weights. Keys with zero weight are dropped.'''
+    def __init__(self, keys_weights):
+        self.keys       = []
+        self.cumulative = []
+        self.total      = 0
+        for key,weight in keys_weights:
+            if weight>0:
+                self.total += weight
+                self.keys.append(key)
+                self.cumulative.append(self.total)
+
+    def draw(self, rng=random):
+        assert self.total>0, 'No choices with a non-zero weight'
+        if len(self.keys)==1:  return self.keys[0]
+        return self.keys[bisect.bisect_right(self.cumulative, rng.randrange(self.total))]
+
+
+def weighted_choice(keys_weights, rng=random):
     if len(keys_weights)==1:   return keys_weights[0][0]
     total = sum(w for _,w in keys_weights)
     assert total>0, keys_weights
-    choice = random.randrange(total)
+    choice = rng.randrange(total)
     weight_sum = 0
     for pos,(key,weight) in enumerate(keys_weights):
         if choice < weight_sum+weight:
@@ -100,94 +125,760 @@ def weighted_choice(keys_weights):
         weight_sum += weight
     assert False
 
+def convolve(a, b, size):
+    '''Multiply the polynomials with coefficient lists *a* and *b*, truncated to size+1 coefficients. Each list
+       is packed into a single integer with a fixed-width field per coefficient (Kronecker substitution), so the
+       whole convolution is one big-integer multiplication instead of a loop over every pair of sizes.'''
+    a, b = a[:size+1], b[:size+1]
+    if len(a)==0 or len(b)==0 or max(a)==0 or max(b)==0:
+        return [0] * (size+1)
+    width = ((max(a) * max(b) * min(len(a),len(b))).bit_length() + 8) // 8
+    product = int.from_bytes(b''.join(c.to_bytes(width,'little') for c in a), 'little') * \
+              int.from_bytes(b''.join(c.to_bytes(width,'little') for c in b), 'little')
+    packed = product.to_bytes(width * (len(a)+len(b)), 'little')
+    result = [ int.from_bytes(packed[i*width:(i+1)*width], 'little') for i in range(min(size+1,len(a)+len(b))) ]
+    return result + [0] * (size+1-len(result))
+
+
+def terminal_vector(symbol, size):
+    '''The number of ways that a symbol without sub-expansions covers each number of terminals up to *size*.'''
+    if not symbol.isTerminal:
+        pattern = lambda n: 1 if n==0 else 0
+    else:
+        pattern = { "just":     lambda n: 1 if n==1 else 0,
+                    "optional": lambda n: 1 if n<=1 else 0,
+                    "any":      lambda n: 1,
+                    "some":     lambda n: 1 if n>=1 else 0 }[symbol.modifier]
+    return [ pattern(n) for n in range(size+1) ]
+
+
+class CountTables:
+    '''Bottom-up counting: the number of expansions of every rule into exactly n terminals, for all n up to the
+       filled size. Each clause is counted as a convolution of the size vectors of its symbols: prefixes[clause][j]
+       is the vector for the symbols at positions order[clause][:j+1], so the final prefix is the count for the
+       clause and sampling can walk back through the prefixes to allocate sizes to symbols without enumerating
+       partitions. The modifiers on non-terminals are counted as separate vectors (optional, any and some).
+
+       Rules are filled one strongly connected component at a time, dependencies first. Symbols whose vectors
+       are complete before a component is filled (terminals and non-terminals from earlier components) come
+       first in the order and are convolved for all sizes at once. Only the symbols inside a recursive component
+       are filled one size at a time, where a layer at size n only depends on the rules at size n through
+       symbols that can be empty.'''
+    def __init__(self, grammar, size=0, stats=None):
+        self.grammar  = grammar
+        self.size     = -1
+        self.stats    = stats
+        self.clauses  = { name:sorted(rule.clauses, key=clause_key) for name,rule in grammar.rules.items() }
+        self.rules    = { name:[] for name in grammar.rules }
+        self.symbols  = {}
+        self.layer    = {}
+        self.active   = set()
+        self.weights  = {}
+        for clauses in self.clauses.values():
+            for clause in clauses:
+                for symbol in clause.rhs:
+                    if symbol.isNonterminal and symbol.modifier!="just":
+                        self.symbols[(symbol.name,symbol.modifier)] = []
+                    if symbol.isNonterminal and symbol.modifier=="some":
+                        self.symbols[(symbol.name,"any")] = []
+        self.components = self.find_components()
+        self.component  = { name:component for component in self.components for name in component }
+        self.order, self.external, self.prefixes = {}, {}, {}
+        for component in self.components:
+            for name in component:
+                for clause in self.clauses[name]:
+                    internal = [ self.recursive(component) and s.isNonterminal and s.name in component
+                                 for s in clause.rhs ]
+                    self.order[clause] = sorted(range(len(clause.rhs)), key=lambda i:(internal[i],i))
+                    self.external[clause] = internal.count(False)
+                    self.prefixes[clause] = [ [] for _ in clause.rhs ]
+        self.extend(size)
+
+    def find_components(self):
+        '''Tarjan's algorithm over the references between rules, the components are produced in dependency
+           order (a component only refers to itself and earlier components).'''
+        index, low, stack, onStack, result = {}, {}, [], set(), []
+        def visit(name):
+            index[name] = low[name] = len(index)
+            stack.append(name)
+            onStack.add(name)
+            for clause in self.clauses[name]:
+                for symbol in clause.rhs:
+                    if not symbol.isNonterminal:
+                        continue
+                    if symbol.name not in index:
+                        visit(symbol.name)
+                        low[name] = min(low[name], low[symbol.name])
+                    elif symbol.name in onStack:
+                        low[name] = min(low[name], index[symbol.name])
+            if low[name]==index[name]:
+                component = []
+                while len(component)==0 or component[-1]!=name:
+                    component.append(stack.pop())
+                    onStack.discard(component[-1])
+                result.append(tuple(reversed(component)))
+        for name in self.clauses:
+            if name not in index:
+                visit(name)
+        return result
+
+    def recursive(self, component):
+        return len(component)>1 or any(s.isNonterminal and s.name==component[0]
+                                       for clause in self.clauses[component[0]] for s in clause.rhs)
+
+    def extend(self, size):
+        '''Fill the tables for every size up to *size*.'''
+        if size<=self.size:
+            return self
+        for component in self.components:
+            if self.stats is not None:
+                start = time.perf_counter()
+            for name in component:
+                for clause in self.clauses[name]:
+                    self.extend_external(clause, size)
+            if self.recursive(component):
+                for n in range(self.size+1, size+1):
+                    self.extend_layer(component, n)
+            else:
+                name = component[0]
+                self.rules[name] = [ sum(column) for column in
+                                     zip(*[ self.clause_vector(clause, size) for clause in self.clauses[name] ]) ]
+                for modifier in ("optional","any","some"):
+                    if (name,modifier) in self.symbols:
+                        self.symbols[(name,modifier)] = []
+                        for n in range(size+1):
+                            self.layer = {}
+                            self.symbols[(name,modifier)].append(self.nonterminal_count(name, modifier, n))
+            if self.stats is not None:
+                self.stats.rule_time[",".join(component)] += time.perf_counter() - start
+                self.stats.rule_calls[",".join(component)] += 1
+        self.size = size
+        return self
+
+    def snapshot(self):
+        '''The filled tables keyed by stable descriptions of the clauses, suitable for pickling into a CountCache.'''
+        return { 'size':     self.size,
+                 'rules':    self.rules,
+                 'symbols':  self.symbols,
+                 'prefixes': { clause_key(c):p for c,p in self.prefixes.items() } }
+
+    def restore(self, snapshot):
+        '''Warm-start from a snapshot of tables over the same grammar if it is larger than the current fill.'''
+        if snapshot is None or snapshot['size']<=self.size:
+            return self
+        self.size    = snapshot['size']
+        self.rules   = { name:list(v) for name,v in snapshot['rules'].items() }
+        self.symbols = { key:list(v) for key,v in snapshot['symbols'].items() }
+        self.prefixes = { c:[ list(v) for v in snapshot['prefixes'][clause_key(c)] ] for c in self.prefixes }
+        return self
+
+    def extend_external(self, clause, size):
+        '''Convolve the symbols that come before the recursive ones in the order for all sizes at once.'''
+        previous = [1] + [0] * size
+        for j in range(self.external[clause]):
+            previous = convolve(previous, self.vector(clause.rhs[self.order[clause][j]], size), size)
+            self.prefixes[clause][j] = previous
+
+    def extend_layer(self, component, n):
+        self.layer  = {}
+        self.active = set()
+        for name in component:
+            self.rule_count(name, n)
+        for name in component:
+            for clause in self.clauses[name]:
+                for j in range(self.external[clause], len(clause.rhs)):
+                    self.prefixes[clause][j].append(self.prefix_count(clause, j, n))
+            for modifier in ("optional","any","some"):
+                if (name,modifier) in self.symbols:
+                    self.symbols[(name,modifier)].append(self.nonterminal_count(name, modifier, n))
+        for name in component:
+            self.rules[name].append(self.layer[('rule',name)])
+
+    def vector(self, symbol, size):
+        if not symbol.isNonterminal:
+            return terminal_vector(symbol, size)
+        if symbol.modifier=="just":
+            return self.rules[symbol.name][:size+1]
+        return self.symbols[(symbol.name,symbol.modifier)][:size+1]
+
+    def stored(self, symbol):
+        '''The filled vector for a non-terminal symbol, as it is being extended.'''
+        if symbol.modifier=="just":
+            return self.rules[symbol.name]
+        return self.symbols[(symbol.name,symbol.modifier)]
+
+    def clause_vector(self, clause, size):
+        if len(clause.rhs)==0:
+            return [1] + [0] * size
+        return self.prefixes[clause][-1][:size+1]
+
+    def rule_count(self, name, n):
+        if n<len(self.rules[name]):
+            return self.rules[name][n]
+        key = ('rule',name)
+        if key not in self.layer:
+            assert key not in self.active, f'Rule {name} derives itself at size {n} without consuming terminals'
+            self.active.add(key)
+            self.layer[key] = sum(self.clause_count(clause, n) for clause in self.clauses[name])
+            self.active.discard(key)
+        return self.layer[key]
+
+    def clause_count(self, clause, n):
+        if len(clause.rhs)==0:
+            return 1 if n==0 else 0
+        return self.prefix_count(clause, len(clause.rhs)-1, n)
+
+    def prefix_count(self, clause, j, n):
+        if n<len(self.prefixes[clause][j]):
+            return self.prefixes[clause][j][n]
+        key = ('prefix',clause,j)
+        if key not in self.layer:
+            symbol = clause.rhs[self.order[clause][j]]
+            if j==0:
+                total = self.symbol_count(symbol, n)
+            else:
+                # The products that only involve smaller sizes are a dot product over the filled vectors, the
+                # current size is only looked at when the other side of the product can be zero-sized.
+                previous = self.prefixes[clause][j-1]
+                total = sum(map(operator.mul, previous[n-1:0:-1], self.stored(symbol)[1:n]))
+                if self.prefix_count(clause,j-1,0)!=0:
+                    total += self.prefix_count(clause,j-1,0) * self.symbol_count(symbol,n)
+                if n>0 and self.symbol_count(symbol,0)!=0:
+                    total += self.prefix_count(clause,j-1,n) * self.symbol_count(symbol,0)
+            self.layer[key] = total
+        return self.layer[key]
+
+    def symbol_count(self, symbol, n):
+        if not symbol.isNonterminal:
+            return terminal_vector(symbol, n)[n]
+        if symbol.modifier=="just":
+            return self.rule_count(symbol.name, n)
+        return self.nonterminal_count(symbol.name, symbol.modifier, n)
+
+    def nonterminal_count(self, name, modifier, n):
+        if n<len(self.symbols[(name,modifier)]):
+            return self.symbols[(name,modifier)][n]
+        key = (name,modifier)
+        if key not in self.layer:
+            if modifier=="optional":
+                total = 1 if n==0 else self.rule_count(name, n)
+            elif n==0:
+                total = 1 if modifier=="any" else 0
+            else:
+                # The first repetition takes p terminals and the rest are a (possibly empty) sequence
+                total = sum(map(operator.mul, self.rules[name][1:n], self.symbols[(name,"any")][n-1:0:-1])) + \
+                        self.rule_count(name, n) * self.nonterminal_count(name, "any", 0)
+            self.layer[key] = total
+        return self.layer[key]
+
+    def weight_table(self, key, choices):
+        '''The WeightTable for *key*, built from the (key,weight) pairs produced by *choices* on first use.'''
+        if key not in self.weights:
+            self.weights[key] = WeightTable(choices())
+        return self.weights[key]
+
+    def sample_rule(self, name, size, rng=random):
+        self.extend(size)
+        table = self.weight_table(('rule',name,size), lambda: [ (clause, self.clause_count(clause,size))
+                                                                for clause in self.clauses[name] ])
+        if table.total==0:
+            return None
+        return self.sample_clause(table.draw(rng), size, rng)
+
+    def sample_clause(self, clause, size, rng=random):
+        '''Walk back through the prefixes choosing the size of each symbol from the last in the order to the
+           first.'''
+        sizes = [0] * len(clause.rhs)
+        order = self.order[clause]
+        for j in range(len(order)-1, 0, -1):
+            symbol = clause.rhs[order[j]]
+            table = self.weight_table(('split',clause,j,size),
+                                      lambda: [ (k, self.prefixes[clause][j-1][size-k] * self.symbol_count(symbol,k))
+                                                for k in range(size+1) ])
+            sizes[order[j]] = table.draw(rng)
+            size -= sizes[order[j]]
+        if len(order)>0:
+            sizes[order[0]] = size
+        result = []
+        for symbol, n in zip(clause.rhs, sizes):
+            result.extend(self.sample_symbol(symbol, n, rng))
+        return result
+
+    def sample_symbol(self, symbol, size, rng=random):
+        if symbol.isTerminal:
+            return [symbol] * size
+        if not symbol.isNonterminal:
+            return [symbol]
+        if symbol.modifier=="optional" and size==0:
+            return []
+        if symbol.modifier in ("just","optional"):
+            return self.sample_rule(symbol.name, size, rng)
+        result = []
+        while size>0:
+            table = self.weight_table(('repeat',symbol.name,size),
+                                      lambda: [ (p, self.rule_count(symbol.name,p) *
+                                                    self.nonterminal_count(symbol.name,"any",size-p))
+                                                for p in range(1,size+1) ])
+            prefix = table.draw(rng)
+            result.extend(self.sample_rule(symbol.name, prefix, rng))
+            size -= prefix
+        return result
+
+
+def poly_mul(a, b, limit):
+    '''Multiply two sparse polynomials over the bias counts, dropping the terms above *limit*.'''
+    result = {}
+    for ka,va in a.items():
+        for kb,vb in b.items():
+            k = tuple(map(operator.add, ka, kb))
+            if all(map(operator.le, k, limit)):
+                result[k] = result.get(k,0) + va*vb
+    return result
+
+
+def poly_add(target, poly):
+    for k,v in poly.items():
+        target[k] = target.get(k,0) + v
+    return target
+
+
+class BiasTables:
+    '''Counting with bias: the number of expansions of each rule into n terminals that contain exactly the
+       given number of expansions of each biased non-terminal. The count for each size is a sparse polynomial
+       over the bias counts (a dict from the vector of counts to the number of expansions) truncated at the
+       target vector. The bias becomes extra dimensions of the size tables, so a clause is counted by
+       convolving the polynomials of its symbols instead of enumerating every partition of the bias over them.
+       The memoised polynomials and weights are each bounded to *capacity* entries.'''
+    def __init__(self, grammar, bias, capacity=None):
+        self.grammar  = grammar
+        self.names    = tuple(name for name,_ in bias)
+        self.target   = tuple(count for _,count in bias)
+        self.zero     = (0,) * len(self.names)
+        self.units    = { name:tuple(int(n==name) for n in self.names) for name in self.names }
+        self.clauses  = { name:sorted(rule.clauses, key=clause_key) for name,rule in grammar.rules.items() }
+        self.rules    = LRUDict(capacity)
+        self.prefixes = LRUDict(capacity)
+        self.weights  = LRUDict(capacity)
+        self.active   = set()
+        self.nullable = self.find_nullable()
+
+    def find_nullable(self):
+        '''The rules that can expand to no terminals, found as a fixed point.'''
+        nullable, changed = set(), True
+        while changed:
+            changed = False
+            for name,clauses in self.clauses.items():
+                if name not in nullable and any(all(self.empty(s,nullable) for s in c.rhs) for c in clauses):
+                    nullable.add(name)
+                    changed = True
+        return nullable
+
+    def empty(self, symbol, nullable=None):
+        '''Can the symbol expand to no terminals?'''
+        nullable = self.nullable if nullable is None else nullable
+        if symbol.modifier in ("optional","any") or not (symbol.isTerminal or symbol.isNonterminal):
+            return True
+        return symbol.isNonterminal and symbol.name in nullable
+
+    def rule_poly(self, name, n):
+        key = (name,n)
+        result = self.rules.get(key)
+        if result is None:
+            assert key not in self.active, f'Rule {name} derives itself at size {n} without consuming terminals'
+            self.active.add(key)
+            result = {}
+            for clause in self.clauses[name]:
+                poly_add(result, self.clause_poly(clause, n))
+            self.rules.store(key, result)
+            self.active.discard(key)
+        return result
+
+    def expansion_poly(self, name, n):
+        '''The polynomial for one expansion of a non-terminal, counting the expansion itself if it is biased.'''
+        if name not in self.units:
+            return self.rule_poly(name, n)
+        return poly_mul(self.rule_poly(name, n), {self.units[name]:1}, self.target)
+
+    def prefix_poly(self, clause, j, n):
+        '''The polynomial for the first j symbols of the clause expanding to n terminals.'''
+        if j==0:
+            return {self.zero:1} if n==0 else {}
+        key = (clause,j,n)
+        result = self.prefixes.get(key)
+        if result is None:
+            result = {}
+            for k,prefix,poly in self.splits(clause, j, n):
+                poly_add(result, poly_mul(prefix, poly, self.target))
+            self.prefixes.store(key, result)
+        return result
+
+    def splits(self, clause, j, n):
+        '''The sizes k that the j-th symbol can take with the polynomials for the prefix before it at n-k and the
+           symbol at k. A symbol at size n is only counted when the prefix can be empty (and vice versa),
+           otherwise recursive rules would depend on themselves.'''
+        symbol = clause.rhs[j-1]
+        for k in range(n+1):
+            if k==0 and not self.empty(symbol):
+                continue
+            if k==n and not all(self.empty(s) for s in clause.rhs[:j-1]):
+                continue
+            prefix = self.prefix_poly(clause, j-1, n-k)
+            poly   = self.symbol_poly(symbol, k) if len(prefix)>0 else {}
+            if len(poly)>0:
+                yield k, prefix, poly
+
+    def clause_poly(self, clause, n):
+        return self.prefix_poly(clause, len(clause.rhs), n)
+
+    def symbol_poly(self, symbol, k):
+        if symbol.isTerminal:
+            valid = { "just":k==1, "optional":k<=1, "any":True, "some":k>=1 }[symbol.modifier]
+            return {self.zero:1} if valid else {}
+        if not symbol.isNonterminal:
+            return {self.zero:1} if k==0 else {}
+        if symbol.modifier in ("optional","any") and k==0:
+            return {self.zero:1}
+        if symbol.modifier in ("just","optional"):
+            return self.expansion_poly(symbol.name, k)
+        return self.sequence_poly(symbol.name, k)
+
+    def sequence_poly(self, name, k):
+        '''A sequence of one or more expansions of the non-terminal, each expansion takes at least one terminal.'''
+        key = ('sequence',name,k)
+        result = self.rules.get(key)
+        if result is None:
+            result = {}
+            for p in range(1,k+1):
+                rest = self.sequence_poly(name, k-p) if p<k else {self.zero:1}
+                poly_add(result, poly_mul(self.expansion_poly(name,p), rest, self.target))
+            self.rules.store(key, result)
+        return result
+
+    def rule_count(self, name, n):
+        return self.rule_poly(name, n).get(self.target, 0)
+
+    def clause_count(self, clause, n):
+        return self.clause_poly(clause, n).get(self.target, 0)
+
+    def symbol_count(self, symbol, n):
+        return self.symbol_poly(symbol, n).get(self.target, 0)
+
+    def weight_table(self, key, choices):
+        table = self.weights.get(key)
+        if table is None:
+            table = WeightTable(choices())
+            self.weights.store(key, table)
+        return table
+
+    def sample_rule(self, name, n, rng=random, bias=None):
+        bias = self.target if bias is None else bias
+        table = self.weight_table(('rule',name,n,bias), lambda: [ (clause, self.clause_poly(clause,n).get(bias,0))
+                                                                  for clause in self.clauses[name] ])
+        if table.total==0:
+            return None
+        return self.sample_clause(table.draw(rng), n, bias, rng)
+
+    def sample_clause(self, clause, n, bias, rng=random):
+        '''Walk back through the prefixes choosing the size and bias counts of each symbol from the last.'''
+        parts = [None] * len(clause.rhs)
+        for j in range(len(clause.rhs), 0, -1):
+            table = self.weight_table(('split',clause,j,n,bias), lambda: [
+                        ((k,sub), prefix.get(tuple(map(operator.sub,bias,sub)),0) * count)
+                        for k,prefix,poly in self.splits(clause, j, n) for sub,count in poly.items() ])
+            parts[j-1] = table.draw(rng)
+            n, bias = n-parts[j-1][0], tuple(map(operator.sub, bias, parts[j-1][1]))
+        result = []
+        for symbol,(k,sub) in zip(clause.rhs, parts):
+            result.extend(self.sample_symbol(symbol, k, sub, rng))
+        return result
+
+    def sample_symbol(self, symbol, k, bias, rng=random):
+        if symbol.isTerminal:
+            return [symbol] * k
+        if not symbol.isNonterminal:
+            return [symbol]
+        if symbol.modifier in ("optional","any") and k==0:
+            return []
+        if symbol.modifier in ("just","optional"):
+            return self.sample_expansion(symbol.name, k, bias, rng)
+        result = []
+        while k>0:
+            table = self.weight_table(('repeat',symbol.name,k,bias), lambda: [
+                        ((p,sub), count * (self.sequence_poly(symbol.name,k-p) if p<k else {self.zero:1})
+                                          .get(tuple(map(operator.sub,bias,sub)),0))
+                        for p in range(1,k+1) for sub,count in self.expansion_poly(symbol.name,p).items() ])
+            p, sub = table.draw(rng)
+            result.extend(self.sample_expansion(symbol.name, p, sub, rng))
+            k, bias = k-p, tuple(map(operator.sub, bias, sub))
+        return result
+
+    def sample_expansion(self, name, k, bias, rng=random):
+        if name in self.units:
+            bias = tuple(map(operator.sub, bias, self.units[name]))
+        return self.sample_rule(name, k, rng, bias)
+
+
+def parallel_init(sampler):
+    global workerSampler
+    workerSampler = sampler
+
+
+def parallel_range(task):
+    ruleName, size, bias, seed, render, start, stop = task
+    result = []
+    for i in range(start, stop):
+        rng = random.Random(f'{seed}/{i}')
+        sample = workerSampler.sample_rule(ruleName, size, bias, rng)
+        result.append(renderText(sample, rng) if render and sample is not None else sample)
+    return result
+
+
+def symbol_key(symbol):
+    '''A description of a grammar symbol that is stable between runs (unlike the objects and the order of the
+       characters in a TermSet).'''
+    if isinstance(symbol, Grammar.TermString):
+        return ('T', symbol.string, symbol.modifier)
+    if isinstance(symbol, Grammar.TermSet):
+        return ('S', "".join(sorted(symbol.chars)), symbol.inverse, symbol.modifier)
+    if isinstance(symbol, Grammar.Nonterminal):
+        return ('N', symbol.name, symbol.modifier)
+    return (type(symbol).__name__,)
+
+
+def clause_key(clause):
+    return (clause.lhs, tuple(symbol_key(s) for s in clause.rhs))
+
+
+def grammar_fingerprint(grammar):
+    rules = [ (name, sorted(clause_key(c) for c in rule.clauses)) for name,rule in sorted(grammar.rules.items()) ]
+    return hashlib.sha256(repr(rules).encode('utf-8')).hexdigest()[:16]
+
+
+class CountCache:
+    '''A bounded cache of counts that can be shared by every Sampler over the same grammar. The keys only use
+       stable descriptions of the rules, clauses and symbols so the cache can be saved into *directory* under
+       the fingerprint of the grammar, and a later cache over the same grammar warm-starts from the file. At
+       most *capacity* entries are kept, the least-recently used are evicted first.'''
+    def __init__(self, grammar, capacity=1000000, directory=None):
+        self.fingerprint = grammar_fingerprint(grammar)
+        self.capacity    = capacity
+        self.entries     = LRUDict(capacity)
+        self.path        = None
+        if directory is not None:
+            self.path = os.path.join(directory, f'{self.fingerprint}.counts')
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for k,v in pickle.load(f):
+                        self.entries.store(k,v)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def store(self, key, value):
+        self.entries.store(key, value)
+
+    def save(self):
+        assert self.path is not None, 'CountCache was not given a directory to save into'
+        with open(self.path, 'wb') as f:
+            pickle.dump(list(self.entries.map.items()), f)
+
+
+class SamplerStats:
+    '''Opt-in instrumentation for the Sampler: hits and misses on the counting memo, the number of clause
+       partitions enumerated and the time spent counting each rule. The rule times are inclusive of the rules
+       that they call. With bottom-up tables the time is recorded for each component of rules as it is filled.'''
+    def __init__(self):
+        self.memo_hits   = 0
+        self.memo_misses = 0
+        self.partitions  = 0
+        self.rule_time   = collections.Counter()
+        self.rule_calls  = collections.Counter()
+
+    def lookup(self, hit):
+        if hit:
+            self.memo_hits += 1
+        else:
+            self.memo_misses += 1
+
+    def report(self, file=sys.stdout):
+        print(f'memo hits={self.memo_hits} misses={self.memo_misses} partitions={self.partitions}', file=file)
+        for name, seconds in self.rule_time.most_common():
+            print(f'  {name}: {seconds:.4f}s over {self.rule_calls[name]} calls', file=file)
+
+
 class Sampler:
-    def __init__(self, grammar):
+    '''Uniform sampling of the sentences of a given size from a grammar. By default the counts are found by
+       top-down recursion over the ClauseAllocation partitions, with *bottomup* the unbiased counts come from
+       CountTables filled for all rules and sizes instead. Biased counts always come from BiasTables. Passing a
+       SamplerStats as *stats* records where the counting spends its time. The counts are kept in a CountCache,
+       pass the same *cache* to Samplers over the same grammar to reuse them.'''
+    def __init__(self, grammar, bottomup=False, stats=None, cache=None):
         self.grammar = grammar
-        self.memo    = {}
-
-    def sample_rule(self, ruleName, size, bias=[]):
-        rule = self.grammar.rules[ruleName]
-        choices = [ (clause, self.count_clause(clause,size,bias))  for clause in rule.clauses ]
-        for clause,count in choices:
-            print(clause,count)
-        if sum(count for _,count in choices)==0:
+        self.cache   = CountCache(grammar) if cache is None else cache
+        self.keys    = {}
+        self.weights = LRUDict(self.cache.capacity)
+        self.ordered = {}
+        self.allocations = LRUDict(self.cache.capacity)
+        self.biased  = LRUDict(self.cache.capacity)
+        self.stats   = stats
+        self.tables  = None
+        assert self.cache.fingerprint==grammar_fingerprint(grammar), 'CountCache belongs to another grammar'
+        if bottomup:
+            self.tables = CountTables(grammar, stats=stats)
+            self.tables.restore(self.cache.get(('tables',)))
+
+    def save(self):
+        '''Store the bottom-up tables in the cache and write the cache to disk.'''
+        if self.tables is not None:
+            self.cache.store(('tables',), self.tables.snapshot())
+        self.cache.save()
+
+    def key(self, clause):
+        if clause not in self.keys:
+            self.keys[clause] = clause_key(clause)
+        return self.keys[clause]
+
+    def clauses(self, ruleName):
+        '''The clauses of a rule in a stable order (Rule.clauses is a set of objects hashed by identity, so its
+           order differs between processes).'''
+        if ruleName not in self.ordered:
+            self.ordered[ruleName] = sorted(self.grammar.rules[ruleName].clauses, key=self.key)
+        return self.ordered[ruleName]
+
+    def allocation(self, clause):
+        alloc = self.allocations.get(clause)
+        if alloc is None:
+            alloc = ClauseAllocation(clause.rhs)
+            self.allocations.store(clause, alloc)
+        return alloc
+
+    def weight_table(self, key, choices):
+        '''The WeightTable for *key*, built from the (key,weight) pairs produced by *choices* on first use.'''
+        table = self.weights.get(key)
+        if table is None:
+            table = WeightTable(choices())
+            self.weights.store(key, table)
+        return table
+
+    def bias_tables(self, bias):
+        key = tuple(bias)
+        tables = self.biased.get(key)
+        if tables is None:
+            tables = BiasTables(self.grammar, key, capacity=self.cache.capacity)
+            self.biased.store(key, tables)
+        return tables
+
+    def sample_many(self, ruleName, size, n, bias=[], seed=None):
+        '''Draw *n* samples of *ruleName* with *size* terminals. The weights of every choice are computed on the
+           first draw that needs them and reused by the rest. Passing a *seed* makes the samples reproducible.'''
+        rng = random if seed is None else random.Random(seed)
+        return [ self.sample_rule(ruleName, size, bias, rng) for i in range(n) ]
+
+    def sample_parallel(self, ruleName, size, n, bias=[], seed=0, workers=None, render=False, chunk=64):
+        '''Draw *n* samples across a pool of *workers* processes. The counts are computed once here and the
+           Sampler is copied into each worker. Sample i is drawn from its own RNG seeded by (*seed*, i) so the
+           corpus only depends on the seed and not on the number of workers or the chunking. When *render* is
+           set the workers return the text of each sample (rendered with the same RNG) instead of terminals.'''
+        self.count_rule(ruleName, size, bias)
+        ranges = [ (ruleName, size, bias, seed, render, start, min(start+chunk,n)) for start in range(0,n,chunk) ]
+        if workers==1:
+            parallel_init(self)
+            return list(itertools.chain.from_iterable(map(parallel_range, ranges)))
+        with multiprocessing.Pool(workers, initializer=parallel_init, initargs=(self,)) as pool:
+            return list(itertools.chain.from_iterable(pool.imap(parallel_range, ranges)))
+
+    def sample_rule(self, ruleName, size, bias=[], rng=random):
+        if self.tables is not None and len(bias)==0:
+            return self.tables.sample_rule(ruleName, size, rng)
+        if len(bias)>0:
+            return self.bias_tables(bias).sample_rule(ruleName, size, rng)
+        table = self.weight_table(('rule',ruleName,size,tuple(bias)),
+                                  lambda: [ (clause, self.count_clause(clause,size,bias))
+                                            for clause in self.clauses(ruleName) ])
+        if table.total==0:
             return None
-        clause = weighted_choice(choices)
-        return self.sample_clause(clause, size, bias)
-
-    def count_rule(self, ruleName, size, bias, dbgdepth=''):
-        key = (ruleName,size)
-        if key in self.memo:
-            return self.memo[key]
-        rule = self.grammar.rules[ruleName]
-        result = sum( self.count_clause(clause,size,bias, dbgdepth=dbgdepth+'  ') for clause in rule.clauses)
-        self.memo[key] = result
+        return self.sample_clause(table.draw(rng), size, bias, rng)
+
+    def count_rule(self, ruleName, size, bias):
+        if self.tables is not None and len(bias)==0:
+            return self.tables.extend(size).rule_count(ruleName, size)
+        key = ('rule',ruleName,size,tuple(bias))
+        result = self.cache.get(key)
+        if self.stats is not None:
+            self.stats.lookup(result is not None)
+        if result is not None:
+            return result
+        if self.stats is not None:
+            start = time.perf_counter()
+        if len(bias)>0:
+            result = self.bias_tables(bias).rule_count(ruleName, size)
+        else:
+            result = sum( self.count_clause(clause,size,bias) for clause in self.clauses(ruleName))
+        self.cache.store(key, result)
+        if self.stats is not None:
+            self.stats.rule_time[ruleName] += time.perf_counter() - start
+            self.stats.rule_calls[ruleName] += 1
         return result
 
-    def count_nonterminal(self, symbol, size, bias, dbgdepth=''):
-        print(f'{dbgdepth}count_nonterminal {symbol} {size} {bias}')
-        biasCount = None
-        for name,count in bias:
-            if name==symbol.name:
-                biasCount = count
-        print(f'{dbgdepth} biasCount={biasCount}')
-        if biasCount==0:
-            return 0
-        key = (symbol,size,tuple(bias))
-        if key in self.memo:
-            print(f'{dbgdepth} memo {key} <- {self.memo[key]}')
-            return self.memo[key]
+    def count_nonterminal(self, symbol, size, bias):
+        if self.tables is not None and len(bias)==0:
+            return self.tables.extend(size).symbol_count(symbol, size)
+        key = ('nonterminal',symbol.name,symbol.modifier,size,tuple(bias))
+        result = self.cache.get(key)
+        if self.stats is not None:
+            self.stats.lookup(result is not None)
+        if result is not None:
+            return result
+        if len(bias)>0:
+            result = self.bias_tables(bias).symbol_count(symbol, size)
+            self.cache.store(key, result)
+            return result
         if symbol.modifier=="just":
-            if biasCount is None:
-                result = self.count_rule(symbol.name, size, bias, dbgdepth=dbgdepth+'  ')
-            else:
-                newBias = [(name,count) if name!=symbol.name else (name,biasCount-1) for name,count in bias]
-                print(f'{dbgdepth}bias {biasCount} for {symbol} -> {newBias} ({size})')
-                result = self.count_rule(symbol.name, size, newBias, dbgdepth=dbgdepth+'  ')
-            self.memo[key] = result
-            print(f'{dbgdepth} set memo = {result} {symbol}@{size}')
+            result = self.count_rule(symbol.name, size, bias)
+            self.cache.store(key, result)
             return result
         if symbol.modifier=="any":
             if size==0:  return 1
             combinations = 0
-            # Blow up as termsize * biasNum
             for prefix in range(1,size+1):
-                combinations += self.count_rule(symbol.name, prefix, bias, dbgdepth=dbgdepth+'  ') * \
-                                self.count_nonterminal(symbol, size-prefix, bias, dbgdepth=dbgdepth+'  ')
-            self.memo[key] = combinations
-            print(f'{dbgdepth} set memo = {combinations} {symbol}@{size}')
+                combinations += self.count_rule(symbol.name, prefix, bias) * \
+                                self.count_nonterminal(symbol, size-prefix, bias)
+            self.cache.store(key, combinations)
             return combinations
         if symbol.modifier=="some":
             if size==0:  return 0
             combinations = 0
             suffixSymbol = symbol.copy()
             suffixSymbol.modifier = "any"
-            # Blow up as termsize * biasNum
             for prefix in range(1,size+1):
-                combinations += self.count_rule(symbol.name, prefix, bias, dbgdepth=dbgdepth+'  ') * \
-                                self.count_nonterminal(suffixSymbol, size-prefix, bias, dbgdepth=dbgdepth+'  ')
-            self.memo[key] = combinations
-            print(f'{dbgdepth} set memo = {combinations} {symbol}@{size}')
+                combinations += self.count_rule(symbol.name, prefix, bias) * \
+                                self.count_nonterminal(suffixSymbol, size-prefix, bias)
+            self.cache.store(key, combinations)
             return combinations
         if symbol.modifier=="optional":
             if size==0:  return 1
-            result = self.count_rule(symbol.name, size, bias, dbgdepth=dbgdepth+'  ')
-            self.memo[key] = result
-            print(f'{dbgdepth} set memo = {result} {symbol}@{size}')
+            result = self.count_rule(symbol.name, size, bias)
+            self.cache.store(key, result)
             return result
         assert False
 
 
-    def sample_clause(self, clause, size, bias):
-        alloc = ClauseAllocation(clause.rhs)
-        choices = [ (counts, math.prod(self.count_nonterminal(nonterm, subsize, bias)
-                                      for subsize,nonterm in alloc.assignment_nonterms(counts)))
-                    for counts in alloc.assignments(size) ]
-        choices = [ c for c in choices if c[1]>0 ]
-        if len(choices)==0:
+    def sample_clause(self, clause, size, bias, rng=random):
+        alloc = self.allocation(clause)
+        table = self.weight_table(('clause',clause,size,tuple(bias)),
+                                  lambda: [ (counts, math.prod(self.count_nonterminal(nonterm, subsize, bias)
+                                                               for subsize,nonterm in alloc.assignment_nonterms(counts)))
+                                            for counts in alloc.assignments(size) ])
+        if table.total==0:
             counts = []
         else:
-            counts = weighted_choice(choices)
+            counts = table.draw(rng)
         result = [(),] * len(clause.rhs)
         for pos,symbol in alloc.zero+alloc.one:
             result[pos] = [symbol]
@@ -196,146 +887,181 @@ class Sampler:
             result[pos] = [symbol]*count
         for count,(pos,symbol) in combined[alloc.posNonterms:]:
             if count>0:
-                result[pos] = self.sample_rule(symbol.name,count)
+                result[pos] = self.sample_rule(symbol.name,count,rng=rng)
         return list(itertools.chain.from_iterable([s for s in result if len(s)>0]))
 
 
-    def count_clause(self, clause, size, bias, dbgdepth=''):
-        print(f'{dbgdepth}count_clause {clause} {size} {bias}')
-        key = (clause,size,tuple(bias))
-        if key in self.memo:
-            return self.memo[key]
-        alloc = ClauseAllocation(clause.rhs)
+    def count_clause(self, clause, size, bias):
+        if self.tables is not None and len(bias)==0:
+            return self.tables.extend(size).clause_count(clause, size)
+        key = ('clause',self.key(clause),size,tuple(bias))
+        result = self.cache.get(key)
+        if self.stats is not None:
+            self.stats.lookup(result is not None)
+        if result is not None:
+            return result
+        if len(bias)>0:
+            combinations = self.bias_tables(bias).clause_count(clause, size)
+            self.cache.store(key, combinations)
+            return combinations
+        alloc = self.allocation(clause)
         combinations = 0
         for counts in alloc.assignments(size):
-            print(f'{dbgdepth} counts={counts} bias={bias}')
-            # If we have bias parameters then we cannot avoid the combinatorial blowup of applying the counting
-            # function while checking the distribution (via partition of the integer) of each of number of
-            # the biased non-terminal to each sub-clause (non-terminal expansion) in the clause.
-            if len(bias)>0:
-                all_nonterms = [ (numTerms,symbol) for numTerms,symbol in alloc.assignment_nonterms(counts)]
-                nonterms = [ (numTerms,symbol) for numTerms,symbol in all_nonterms if numTerms>0 ]
-                #print(f' nonterms={nonterms}')
-                # If we have no nonterminal sub-productions to distribute the bias onto then there
-                # are 0 valid expansions matching the bias.
-                if len(nonterms)>0:
-                    biasNames, biasCounts = zip(*bias)
-                    biasDists = [ ordered_partitions_n(count, len(nonterms)) for count in biasCounts ]
-                    biasAssignments = list(itertools.product(*biasDists))
-                    #print(f' biasAssignments={biasAssignments}')
-                    for assignment in biasAssignments:
-                        subBias = list(zip(biasNames,assignment))
-                        assignedCombinations = [ self.count_nonterminal(nonterm, subsize,
-                                                                         [(sb[0],sb[1][i]) for sb in subBias], dbgdepth=dbgdepth+'  ')
-                                                 for i,(subsize,nonterm) in enumerate(nonterms) ]
-                        #print(f' {assignment} -> {assignedCombinations}')
-                        combinations += math.prod(assignedCombinations)
-                else:
-                    if all(self.count_nonterminal(nt,0,bias,dbgdepth)>0 for _,nt in all_nonterms):   
-                        print(f'{dbgdepth} ADDONE from {all_nonterms}')
-                        # TODO: We still need to check that it is valid to count the nonterms at size zero......
-                        if sum(v for _,v in bias)==0:
-                            combinations += 1
-                    else:
-                        print(f'SKIP ADDONE from {all_nonterms}')
-            else:
-                combinations += math.prod(self.count_nonterminal(nonterm, subsize, bias, dbgdepth=dbgdepth+'  ')
-                                          for subsize,nonterm in alloc.assignment_nonterms(counts))
-        self.memo[key] = combinations
-        print(f'{dbgdepth}combinations={combinations} {size}@{clause}')
+            if self.stats is not None:
+                self.stats.partitions += 1
+            combinations += math.prod(self.count_nonterminal(nonterm, subsize, bias)
+                                      for subsize,nonterm in alloc.assignment_nonterms(counts))
+        self.cache.store(key, combinations)
         return combinations
 
 
 class Enumerator:
-    def __init__(self, grammar):
+    '''Enumeration of the sentences of a given size in a fixed order by unranking: the k-th sentence is found by
+       walking the CountTables, choosing the clause and then the size of each symbol by the block of ranks that
+       contains k, and splitting the remaining rank between the prefix and the symbol as a mixed-radix number.
+       Only the current derivation is held in memory, any sentence can be reached directly and disjoint ranges
+       of ranks can be enumerated independently.'''
+    def __init__(self, grammar, tables=None):
         self.grammar = grammar
-        self.memo    = {}
+        self.tables  = CountTables(grammar) if tables is None else tables
 
-    def produce(self, ruleName, size):
-        rule = self.grammar.rules[ruleName]
-        for clause in rule.clauses:
-            #print(f'clause: {clause}')
-            for solution in self.produce_clause(clause,size):
-                #print(f' {clause} -> {solution}')
-                yield solution
+    def count(self, ruleName, size):
+        return self.tables.extend(size).rule_count(ruleName, size)
 
-    def produce_clause(self, clause, size):
-        alloc = ClauseAllocation(clause.rhs)
+    def produce(self, ruleName, size, start=0, stop=None):
+        '''A resumable EnumerationCursor over the sentences with ranks in [start,stop).'''
+        return EnumerationCursor(self, ruleName, size, start, stop)
 
-        for counts in alloc.assignments(size):
-            result = [(),] * len(clause.rhs)
-            for pos,symbol in alloc.zero+alloc.one:
-                result[pos] = [symbol]
-            combined = zip(counts, alloc.assignmentOrder)
-            for count,(pos,symbol) in combined:
-                result[pos] = [symbol]*count
-            for subSolution in self.nonterm_seq_expansion(counts[alloc.posNonterms:],
-                                                          alloc.assignmentOrder[alloc.posNonterms:]):
-                for pos,terms in subSolution:
-                    result[pos] = terms
-                yield list(itertools.chain.from_iterable([s for s in result if len(s)>0]))
-
-
-    def nonterm_seq_expansion(self, sizes, nonterms):
-        #print(f' seq_exp: {strs(sizes)} {nonterms}')
-        assert len(sizes)==len(nonterms), (sizes,nonterms)
-        if len(sizes)==0:
-            yield []
-        else:
-            pos,symbol = nonterms[0]
-            size = sizes[0]
-            for initialTerms in self.nonterm_expansion(symbol,size):
-                for rest in self.nonterm_seq_expansion(sizes[1:], nonterms[1:]):
-                    yield [(pos,initialTerms)] + rest
+    def split(self, ruleName, size, parts):
+        '''Divide the ranks of the sentences into (at most) *parts* contiguous ranges of nearly equal length.'''
+        total = self.count(ruleName, size)
+        bounds = [ total*i//parts for i in range(parts+1) ]
+        return [ (lo,hi) for lo,hi in zip(bounds, bounds[1:]) if lo<hi ]
 
-    def nonterm_expansion(self, symbol, size):
-        if symbol.modifier=="just":
-            for result in self.produce(symbol.name,size):
-                yield result
-        elif symbol.modifier=="any":
-            if size==0:
-                yield []
-            else:
-                for i in range(1,size+1):
-                    for initTerms in self.produce(symbol.name,i):
-                        for restTerms in self.nonterm_expansion(symbol,size-i):
-                            yield initTerms + restTerms
-        elif symbol.modifier=="some":
-            if size>0:
-                suffixSymbol = symbol.copy()
-                suffixSymbol.modifier = "any"
-                for i in range(1,size+1):
-                    for initTerms in self.produce(symbol.name,i):
-                        for restTerms in self.nonterm_expansion(suffixSymbol,size-i):
-                            yield initTerms + restTerms
-        elif symbol.modifier=="optional":
-            if size==0:
-                yield []
-            for terms in self.produce(symbol.name,size):
-                yield terms
-
-
-def renderText(terminals):
+    def unrank(self, ruleName, size, rank):
+        if not 0 <= rank < self.count(ruleName, size):
+            raise IndexError(f'No sentence {rank} of size {size} in {ruleName}')
+        return self.unrank_rule(ruleName, size, rank)
+
+    def unrank_rule(self, ruleName, size, rank):
+        for clause in self.tables.clauses[ruleName]:
+            count = self.tables.clause_count(clause, size)
+            if rank<count:
+                return self.unrank_clause(clause, size, rank)
+            rank -= count
+        assert False, f'Rank out of range in {ruleName}'
+
+    def unrank_clause(self, clause, size, rank):
+        tables = self.tables
+        order = tables.order[clause]
+        parts = [None] * len(clause.rhs)
+        for j in range(len(order)-1, 0, -1):
+            symbol = clause.rhs[order[j]]
+            for k in range(size+1):
+                count = tables.symbol_count(symbol, k)
+                block = tables.prefixes[clause][j-1][size-k] * count
+                if rank<block:
+                    rank, parts[order[j]] = divmod(rank, count)
+                    parts[order[j]] = (k, parts[order[j]])
+                    size -= k
+                    break
+                rank -= block
+        if len(order)>0:
+            parts[order[0]] = (size, rank)
+        result = []
+        for symbol,(k,r) in zip(clause.rhs, parts):
+            result.extend(self.unrank_symbol(symbol, k, r))
+        return result
+
+    def unrank_symbol(self, symbol, size, rank):
+        if symbol.isTerminal:
+            return [symbol] * size
+        if not symbol.isNonterminal:
+            return [symbol]
+        if symbol.modifier=="optional" and size==0:
+            return []
+        if symbol.modifier in ("just","optional"):
+            return self.unrank_rule(symbol.name, size, rank)
+        result = []
+        while size>0:
+            for p in range(1,size+1):
+                rest  = self.tables.nonterminal_count(symbol.name, "any", size-p)
+                block = self.tables.rule_count(symbol.name, p) * rest
+                if rank<block:
+                    first, rank = divmod(rank, rest)
+                    result.extend(self.unrank_rule(symbol.name, p, first))
+                    size -= p
+                    break
+                rank -= block
+        return result
+
+
+class EnumerationCursor:
+    '''An iterator over a range of ranks that can be checkpointed: *position* is the rank of the next sentence
+       and state() can be passed back to Enumerator.produce to resume.'''
+    def __init__(self, enumerator, ruleName, size, start=0, stop=None):
+        self.enumerator = enumerator
+        self.ruleName   = ruleName
+        self.size       = size
+        self.position   = start
+        self.stop       = enumerator.count(ruleName, size) if stop is None else stop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position>=self.stop:
+            raise StopIteration
+        result = self.enumerator.unrank(self.ruleName, self.size, self.position)
+        self.position += 1
+        return result
+
+    def state(self):
+        return (self.ruleName, self.size, self.position, self.stop)
+
+
+alphabets = {}
+
+def alphabet(termset):
+    '''The characters that a TermSet can render as, computed once for each distinct set as a sorted tuple.'''
+    key = (termset.chars, termset.inverse)
+    if key not in alphabets:
+        chars = set(string.printable).difference(termset.chars) if termset.inverse else termset.chars
+        alphabets[key] = tuple(sorted(chars))
+    return alphabets[key]
+
+
+def renderParts(terminals, rng=random):
+    '''The pieces of text for a sentence of terminals, with a space between terminals unless glued.'''
     spacing = True
-    texts   = []
+    first   = True
     for t in terminals:
         if isinstance(t, Grammar.TermString):
-            if spacing and len(texts)>0:
-                texts.append(" ")
-            texts.append(t.string)
-        if isinstance(t, Grammar.TermSet):
-            if spacing and len(texts)>0:
-                texts.append(" ")
-            if t.inverse:
-                universe = set(string.printable).difference(t.chars)
-                texts.append(random.choice(list(universe)))
-            else:
-                texts.append(random.choice(list(t.chars)))
-        if isinstance(t, Grammar.Glue):
+            if spacing and not first:
+                yield " "
+            yield t.string
+            first = False
+        elif isinstance(t, Grammar.TermSet):
+            if spacing and not first:
+                yield " "
+            yield rng.choice(alphabet(t))
+            first = False
+        elif isinstance(t, Grammar.Glue):
             spacing = False
-        if isinstance(t, Grammar.Remover):
+        elif isinstance(t, Grammar.Remover):
             spacing = True
-    return "".join(texts)
+
+
+def renderText(terminals, rng=random):
+    return "".join(renderParts(terminals, rng))
+
+
+def renderStream(samples, file=sys.stdout, rng=random):
+    '''Write each sample to *file* as a line of text as it is produced, without building the corpus.'''
+    for terminals in samples:
+        file.writelines(renderParts(terminals, rng))
+        file.write("\n")
+
 
 if __name__=='__main__':
     argParser = argparse.ArgumentParser()
@@ -344,8 +1070,13 @@ if __name__=='__main__':
     argParser.add_argument("-r", "--rule", type=str, default="program")
     argParser.add_argument("-b", "--bias", action='append')
     argParser.add_argument("-n", "--numresults", type=int, default=20)
+    argParser.add_argument("-t", "--tables", action='store_true', help="count with bottom-up tables")
+    argParser.add_argument("--stats", action='store_true', help="report counting statistics")
+    argParser.add_argument("--seed", type=int, help="seed for reproducible samples")
+    argParser.add_argument("-j", "--jobs", type=int, help="sample in parallel across this many processes")
+    argParser.add_argument("-c", "--cache", type=str, help="directory to keep counts in between runs")
     args = argParser.parse_args()
-    bias = [] if args.bias is None else [ s.split('=') for s in args.bias ]
+    bias = [] if args.bias is None else [ (s.split('=')[0],int(s.split('=')[1])) for s in args.bias ]
     bias = [ (name,int(count)) for name,count in bias ]
     stage1g, _, stage1 = buildCommon()
     res = next(stage1.execute( open(args.grammar).read()), None)
@@ -353,7 +1084,18 @@ if __name__=='__main__':
         print(f"Failed to parse grammar from {args.grammar}")
         sys.exit(-1)
     grammar = stage2(res)
-    s = Sampler(grammar)
-    for i in range(args.numresults):
-        print(renderText(s.sample_rule(args.rule,args.size,bias=bias)))
+    stats = SamplerStats() if args.stats else None
+    cache = CountCache(grammar, directory=args.cache) if args.cache is not None else None
+    s = Sampler(grammar, bottomup=args.tables, stats=stats, cache=cache)
+    if args.jobs is not None:
+        seed = random.randrange(2**32) if args.seed is None else args.seed
+        for text in s.sample_parallel(args.rule, args.size, args.numresults, bias, seed, args.jobs, render=True):
+            print(text)
+    else:
+        rng = random if args.seed is None else random.Random(args.seed)
+        renderStream((s.sample_rule(args.rule, args.size, bias, rng) for i in range(args.numresults)), sys.stdout, rng)
+    if cache is not None:
+        s.save()
+    if stats is not None:
+        stats.report()
 
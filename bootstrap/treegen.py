@@ -1,4 +1,4 @@
-import math, random
+import argparse, bisect, itertools, math, random
 
 class Node:
     def __init__(self, children=None):
@@ -224,16 +224,69 @@ def tree_sample(max_degree, nodes):
     return tree_sample_by_degree(max_degree, degree, nodes)
 
 
-d = Distribution()
-n = 5
-for i in range(100000):
-    #d.add( random.randrange(50) )
-    d.add( tree_sample(3,n) )
-d.dump()
-
-
-
-
-
-
 
+# Table-driven sampler
+
+class TreeSampler:
+    '''Uniform sampling of trees with at most *max_degree* children per node and up to *nodes* nodes below the
+       root. The counts are precomputed as arrays: forests[r][m] is the number of ordered forests of r trees
+       with m nodes in total, which is also the number of trees with root degree r and m nodes below the root
+       (the same quantity as memo_count). Each choice is stored as a cumulative array so that sampling draws
+       the degree of a node and the size of each child by binary search, without building lists per node.'''
+    def __init__(self, max_degree, nodes):
+        self.max_degree = max_degree
+        self.nodes      = nodes
+        self.trees      = [1] + [0] * nodes                     # Trees by number of nodes below the root
+        self.forests    = [ [1] + [0] * nodes ] + [ [0] * (nodes+1) for r in range(max_degree) ]
+        for m in range(1, nodes+1):
+            for r in range(1, max_degree+1):
+                self.forests[r][m] = sum(self.trees[s-1] * self.forests[r-1][m-s] for s in range(1,m+1))
+            self.trees[m] = sum(self.forests[r][m] for r in range(1, min(m,max_degree)+1))
+        self.degrees = [ list(itertools.accumulate(self.forests[r][m] for r in range(1, min(m,max_degree)+1)))
+                         for m in range(nodes+1) ]
+        self.splits  = [ [ list(itertools.accumulate(self.trees[s-1] * self.forests[r-1][m-s] for s in range(1,m+1)))
+                           for m in range(nodes+1) ]
+                         for r in range(max_degree+1) ]
+
+    def count(self, nodes=None):
+        return self.trees[self.nodes if nodes is None else nodes]
+
+    @staticmethod
+    def draw(cumulative, rng):
+        return bisect.bisect_right(cumulative, rng.randrange(cumulative[-1]))
+
+    def sample(self, nodes=None, rng=random):
+        '''A uniformly chosen tree with *nodes* nodes below the root (Node.size() is one more).'''
+        nodes = self.nodes if nodes is None else nodes
+        assert 0 <= nodes <= self.nodes, f'TreeSampler only has tables for up to {self.nodes} nodes'
+        root  = Node()
+        stack = [(root, nodes)]
+        while len(stack)>0:
+            node, below = stack.pop()
+            if below==0:
+                continue
+            degree = self.draw(self.degrees[below], rng) + 1
+            for r in range(degree, 0, -1):
+                size = self.draw(self.splits[r][below], rng) + 1
+                stack.append((node.add(), size-1))
+                below -= size
+        return root
+
+    def sample_many(self, count, nodes=None, seed=None):
+        '''A corpus of *count* uniform trees, reproducible when a *seed* is given.'''
+        rng = random if seed is None else random.Random(seed)
+        return [ self.sample(nodes, rng) for i in range(count) ]
+
+
+if __name__=='__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("-d", "--degree", type=int, default=3)
+    argParser.add_argument("-n", "--nodes", type=int, default=5)
+    argParser.add_argument("-s", "--samples", type=int, default=100000)
+    argParser.add_argument("--seed", type=int)
+    args = argParser.parse_args()
+
+    d = Distribution()
+    for tree in TreeSampler(args.degree, args.nodes).sample_many(args.samples, seed=args.seed):
+        d.add(tree)
+    d.dump()
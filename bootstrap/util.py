@@ -1,6 +1,10 @@
 # Copyright (C) 2023 Dr Andrew Moss.    You should have received a copy of the GNU General Public License
 #                                       along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
+import collections
+
+
 class OrdSet:
     '''This class differs from collections.OrderedDict because we can mutate it while iterating over it. The
        add method returns the value to allow canonical values.'''
@@ -58,3 +62,59 @@ class MultiDict:
             self.map[k] = set()
         for v in vs:
             self.map[k].add(v)
+
+
+class LRUDict:
+    '''A dictionary bounded to *capacity* entries that evicts the least-recently used key when it overflows.
+       A capacity of None leaves the dictionary unbounded.'''
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.map      = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, k):
+        return k in self.map
+
+    def get(self, k, default=None):
+        if not k in self.map:
+            return default
+        self.map.move_to_end(k)
+        return self.map[k]
+
+    def store(self, k, v):
+        self.map[k] = v
+        self.map.move_to_end(k)
+        if self.capacity is not None and len(self.map)>self.capacity:
+            self.map.popitem(last=False)
+
+
+class LineIndex:
+    '''Map offsets in a *text* to (line, column) pairs, both counted from 1. The offsets of the line starts are
+       only found on the first query and then each location is a binary search. When the text starts with
+       *prefix* characters that were added in front of the source (e.g. a wrapper) the columns on the first line
+       are counted from the end of the prefix. Offsets past the end of the text are placed at the end.'''
+    def __init__(self, text, prefix=0):
+        self.text   = text
+        self.prefix = prefix
+        self.starts = None
+
+    def location(self, offset):
+        if self.starts is None:
+            self.starts = [0]
+            newline = self.text.find('\n')
+            while newline!=-1:
+                self.starts.append(newline+1)
+                newline = self.text.find('\n', newline+1)
+        offset = min(offset, len(self.text))
+        line = bisect.bisect_right(self.starts, offset)
+        if line==1:
+            return line, max(offset - self.prefix, 0) + 1
+        return line, offset - self.starts[line-1] + 1
+
+    def describe(self, offset):
+        if offset is None:
+            return 'unknown location'
+        line, column = self.location(offset)
+        return f'line {line}, column {column}'
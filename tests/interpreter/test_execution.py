@@ -0,0 +1,140 @@
+import io
+import json
+import pickle
+import sys
+
+import pytest
+
+from bootstrap.parser import Token
+from bootstrap.interpreter import buildPidginParser, Execution, ProgramBuilder, TypingFailed
+from bootstrap.interpreter.execution import Profile
+import bootstrap.interpreter.log as log
+from bootstrap.interpreter.box import Iterator
+from bootstrap.interpreter.numbering import serialise, deserialise
+from bootstrap.util import LineIndex
+
+WRAPPER = 'func main:int [stdin:string] {'
+
+def build(program, parser=None):
+    if parser is None:
+        parser = buildPidginParser(start='program')
+    source = WRAPPER + program + '\nreturn 0}'
+    tree = next(parser.execute(source))
+    return ProgramBuilder(tree if isinstance(tree, Token) else (tree,))
+
+def execute(program, stepped=False, profile=None):
+    builder = build(program)
+    builder.typeEnv.wipe()
+    execution = Execution(builder.outermost, builder.typeEnv, profile=profile)
+    if stepped:
+        while execution.step():
+            pass
+    else:
+        execution.run()
+    return execution
+
+def printed(capsys):
+    return [ line for line in capsys.readouterr().out.split('\n') if line.startswith('Builtin print') ]
+
+def test_loop(capsys):
+    program = 'a = 0\nwhile a<5 {\n    a = a+1\n    print!a\n}'
+    execution = execute(program)
+    compiled = printed(capsys)
+    assert compiled==[ f'Builtin print: box(number,{i})' for i in range(1,6) ]
+    assert execution.stack==[]
+    execute(program, stepped=True)
+    assert printed(capsys)==compiled
+
+def test_call(capsys):
+    execute('func double:int [x:int] {\n  return x+x\n}\na = 0\nwhile a<3 {\n    a = a+1\n    print!(double![x:a])\n}')
+    assert printed(capsys)==[ f'Builtin print: box(number,{i})' for i in (2,4,6) ]
+
+def test_serialisedRoundTrip(capsys):
+    program = 'a = 0\nwhile a<5 {\n    a = a+1\n    print!a\n}'
+    execute(program)
+    expected = printed(capsys)
+    builder = build(program)
+    main = builder.outermost.children['main']
+    data = serialise(main)
+    assert len(data)==len(list(main.entry.reachable()))
+    builder.outermost.children['main'] = deserialise(pickle.loads(pickle.dumps(data)), main.typeEnv)
+    builder.typeEnv.wipe()
+    Execution(builder.outermost, builder.typeEnv).run()
+    assert printed(capsys)==expected
+
+def test_unboxedReboxed(capsys):
+    log.configure(log.INFO, text=sys.stdout)
+    try:
+        execute('a = 0\nd = 0\nwhile a<5 {\n    a = a+1\n    d = d+a\n}\nprint!d')
+    finally:
+        log.configure()
+    out = capsys.readouterr().out.split('\n')
+    assert 'Builtin print: box(number,15)' in out
+    assert '  d :: number = box(number,15)' in out
+
+def test_collectionsInPlace(capsys):
+    execute('x = [1,2,3]\nprint!(len!x)\ni = 0\nwhile i<3 {\n    i = i+1\n    s = {i,5}\n    print!(len!s)\n}')
+    assert printed(capsys)==[ 'Builtin print: box(number,3)' ] + [ 'Builtin print: box(number,2)' ]*3
+
+def test_iterate(capsys):
+    execute('for e in [1,2,3] {\n    print!e\n}\nfor e in {4} {\n    print!e\n}')
+    assert printed(capsys)==[ f'Builtin print: box(number,{i})' for i in (1,2,3,4) ]
+
+def test_iteratorReferences():
+    items = [1,2]
+    it = Iterator(items)
+    items.append(3)
+    assert [ it.advance() for _ in range(3) ]==[1,2,3]
+    assert not it.more()
+    assert not Iterator({}).more()
+    assert Iterator({'k':1}).advance()=='k'
+
+def test_quietByDefault(capsys):
+    execute('a = 1\nprint!a')
+    assert capsys.readouterr().out=='Builtin print: box(number,1)\n'
+
+def test_eventLog(capsys):
+    events = io.StringIO()
+    log.configure(log.TRACE, text=None, eventFile=events)
+    try:
+        execute('a = 1\nprint!a', stepped=True)
+    finally:
+        log.configure()
+    assert capsys.readouterr().out=='Builtin print: box(number,1)\n'
+    records = [ json.loads(line) for line in events.getvalue().split('\n') if len(line)>0 ]
+    kinds = set( r['event'] for r in records )
+    assert {'translate.statement', 'execution.start', 'execution.step', 'execution.done'} <= kinds
+
+def test_profile(capsys):
+    profile = Profile()
+    execution = execute('func double:int [x:int] {\n  return x+x\n}\na = 0\nwhile a<3 {\n    a = a+1\n'
+                        '    print!(double![x:a])\n}', profile=profile)
+    header, count = profile.blocks.most_common(1)[0]
+    assert count==4  and  [ i.op for i in header.instructions ]==['phi','less']
+    assert profile.functionCalls=={'main':1, 'double':3}
+    assert profile.builtinCalls['print']==3
+    report, graph = io.StringIO(), io.StringIO()
+    profile.report(file=report)
+    profile.dot(execution.outermost.children['main'], graph)
+    assert report.getvalue().startswith('Hot blocks:\n  main ')
+    assert 'fillcolor="0.000 1.000 1.000"' in graph.getvalue()
+
+def test_runtimeErrorLocation():
+    def failing(arg):
+        raise RuntimeError('builtin failed')
+    parser = buildPidginParser(start='program')
+    builder = build('a = 1\nb = a+1\nprint!b\nprint!a', parser)
+    builder.typeEnv.wipe()
+    builder.typeEnv.types['print'].builtin = failing
+    execution = Execution(builder.outermost, builder.typeEnv, lines=parser.lines)
+    with pytest.raises(RuntimeError):
+        execution.run()
+    assert execution.location()=='line 3, column 1'
+
+def test_typeErrorLocation():
+    for program, expected in (('print!(len!3)', 'line 1, column 8'), ('a = 1\n  b = len!a', 'line 2, column 7')):
+        parser = buildPidginParser(start='program')
+        with pytest.raises(TypingFailed) as failure:
+            build(program, parser)
+        lines = LineIndex(WRAPPER + program + '\nreturn 0}', prefix=len(WRAPPER))
+        assert failure.value.location(lines)==expected
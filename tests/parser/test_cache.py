@@ -0,0 +1,43 @@
+from bootstrap.grammar import Grammar
+from bootstrap.machine import Automaton
+from bootstrap.parser import Parser, PState, TokenCache
+
+T, N = Grammar.TermString, Grammar.Nonterminal
+
+def setupFixture():
+    '''E: x | E + E'''
+    g = Grammar("E")
+    g.addRule('E', [T("x")], [N("E"), T("+"), N("E")])
+    return Automaton(g)
+
+def statesCreated(parser, input):
+    before = PState.counter
+    results = list(parser.execute(input))
+    return PState.counter - before, results
+
+def test_fewerStates():
+    automaton = setupFixture()
+    plain, ambiguous = statesCreated(Parser(automaton), 'x+x+x+x+x')
+    cache = TokenCache()
+    shared, collapsed = statesCreated(Parser(automaton, cache=cache), 'x+x+x+x+x')
+    assert shared < plain
+    assert len(ambiguous)>1  and  len(collapsed)==1
+    assert cache.hits>0  and  cache.misses>0
+
+def test_sameTreeUnambiguous():
+    automaton = setupFixture()
+    plain  = list(Parser(automaton).execute('x'))
+    shared = list(Parser(automaton, cache=TokenCache()).execute('x'))
+    assert [ (t.start, t.end) for t in plain ]==[ (t.start, t.end) for t in shared ]==[ (0,1) ]
+
+def test_prunedNotCached():
+    '''S: A y | B z  A: x  B: x'''
+    g = Grammar("S")
+    g.addRule('S', [N("A"), T("y")], [N("B"), T("z")])
+    g.addRule('A', [T("x")])
+    g.addRule('B', [T("x")])
+    cache = TokenCache(100)
+    assert len(list(Parser(Automaton(g), cache=cache).execute('xy')))==1
+    names = [ getattr(symbol, 'name', None) for symbol,_ in cache.table.map ]
+    assert 'A' in names  and  'B' not in names
+    assert cache.misses==len(cache.table)
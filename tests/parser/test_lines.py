@@ -0,0 +1,27 @@
+from bootstrap.util import LineIndex
+
+def test_firstAndLastLines():
+    lines = LineIndex('ab\ncd\nef')
+    assert lines.location(0)==(1,1)
+    assert lines.location(1)==(1,2)
+    assert lines.location(3)==(2,1)
+    assert lines.location(7)==(3,2)
+
+def test_newline():
+    lines = LineIndex('ab\ncd\n')
+    assert lines.location(2)==(1,3)
+    assert lines.location(5)==(2,3)
+    assert lines.location(6)==(3,1)
+
+def test_pastEnd():
+    lines = LineIndex('ab\ncd')
+    assert lines.location(5)==(2,3)
+    assert lines.location(50)==(2,3)
+    assert LineIndex('').location(3)==(1,1)
+
+def test_prefix():
+    lines = LineIndex('wrap{ab\ncd}', prefix=5)
+    assert lines.location(5)==(1,1)
+    assert lines.location(6)==(1,2)
+    assert lines.location(9)==(2,2)
+    assert lines.describe(None)=='unknown location'
@@ -0,0 +1,61 @@
+from bootstrap.grammar import Grammar
+from bootstrap.machine import Automaton
+from bootstrap.interpreter import buildPidginParser
+from bootstrap.parser import Parser, PState, Recovery, Token
+
+T, N = Grammar.TermString, Grammar.Nonterminal
+
+def setupFixture():
+    '''L: x | L + x'''
+    g = Grammar("L")
+    g.addRule('L', [T("x")], [N("L"), T("+"), T("x")])
+    return Parser(Automaton(g))
+
+def test_validUnchanged():
+    parser = setupFixture()
+    assert len(list(parser.execute('x+x', recovery=Recovery())))==1
+    assert parser.errors==[()]
+
+def test_noRecovery():
+    parser = setupFixture()
+    assert list(parser.execute('x+?x'))==[]
+
+def test_skipCharacter():
+    parser = setupFixture()
+    trees = list(parser.execute('x+?x', recovery=Recovery()))
+    assert len(trees)>=1
+    assert len(parser.errors)==len(trees)
+    for errors in parser.errors:
+        assert [ (e.span, e.start, e.end) for e in errors ]==[('?',2,3)]
+
+def test_popToken():
+    parser = setupFixture()
+    trees = list(parser.execute('x+x+', recovery=Recovery()))
+    assert len(trees)>=1
+    assert len(parser.errors)==len(trees)
+    for e in parser.errors[0]:
+        assert (e.start, e.end)==(3,4)
+        assert e.span=='+' or [c.span for c in e.children]==['+']
+
+def test_budget():
+    parser = setupFixture()
+    assert list(parser.execute('x+????x', recovery=Recovery(maxCost=3)))==[]
+
+def test_pruningKept(monkeypatch):
+    parser, pruning = setupFixture(), []
+    successors = PState.successors
+    def spy(self, input, prune=False, cache=None, blocked=None):
+        pruning.append(prune)
+        return successors(self, input, prune, cache, blocked)
+    monkeypatch.setattr(PState, 'successors', spy)
+    assert len(list(parser.execute('x+?x', recovery=Recovery())))>=1
+    assert len(pruning)>0  and  all(pruning)
+
+def test_pidginUntransformed():
+    parser = buildPidginParser(start='program')
+    source = 'func main:int [stdin:string] {while { x = 1 }\nreturn 0}'
+    assert list(parser.execute(source))==[]
+    trees = list(parser.execute(source, recovery=Recovery()))
+    assert len(trees)>=1  and  len(parser.errors)==len(trees)
+    assert all( len(errors)>0 for errors in parser.errors )
+    assert isinstance(trees[0], Token)  and  trees[0].damaged()
@@ -0,0 +1,19 @@
+from bootstrap.fuzz import *
+from bootstrap.grammar import Grammar
+
+def test_pidginAccepts():
+    stage1g, _, stage1 = buildCommon()
+    grammar = stage2(next(stage1.execute(open('bootstrap/interpreter/grammar.g').read())))
+    grammar.start, grammar.discard = 'program', stage1g.discard
+    report = fuzz(Parser(Automaton(grammar)), sampled(grammar, 'program', range(2,8), 3, seed=1))
+    assert report.sentences==18
+    assert report.rejected==[]
+    assert report.peak>0
+
+def test_exhaustsAmbiguous():
+    grammar = Grammar('E')
+    grammar.addRule('E', [Grammar.TermString('x')],
+                         [Grammar.Nonterminal('E'), Grammar.TermString('+'), Grammar.Nonterminal('E')])
+    report = fuzz(Parser(Automaton(grammar)), [(1, 'x'), (5, 'x+x+x')])
+    assert report.ambiguous==1  and  report.rejected==[]
+    assert report.seconds>=report.first
@@ -0,0 +1,47 @@
+import itertools
+import os
+
+import pytest
+
+from bootstrap.generator import Generator, ShardFailed
+from bootstrap.interpreter import buildCommon, stage2
+
+listGrammar = '''
+{
+    'list": { [T!'[" NA!'item" T!']"] }
+    'item": { [T!'a"] [T!'b"] [N!'list"] }
+}
+'''
+
+def setupFixture(source=listGrammar):
+    stage1g, _, stage1 = buildCommon()
+    res = next(stage1.execute(source), None)
+    assert res is not None
+    return stage2(res)
+
+def test_exploreShortestFirst():
+    sentences = list(itertools.islice(Generator(setupFixture()).explore(frontier=50, remembered=1000), 40))
+    texts = [ "".join(t.string for t in s) for s in sentences ]
+    assert sorted(texts[:3])==['[]', '[a]', '[b]']
+    assert '[[]]' in texts and '[ab]' in texts
+    assert len(set(texts))==len(texts)
+    assert all(Generator.isAllTerminal(s) for s in sentences)
+
+def test_parallelMerged():
+    generator = Generator(setupFixture()).parallel(2, frontier=50, remembered=1000, batch=4)
+    texts = [ "".join(t.string for t in s) for s in itertools.islice(generator, 40) ]
+    generator.close()
+    assert len(set(texts))==40
+    assert {'[]', '[a]', '[b]'}.issubset(texts)
+
+def test_parallelWorkerFails(monkeypatch):
+    parent = os.getpid()
+    explore = Generator.explore
+    def failing(self, *args):
+        if os.getpid()!=parent:
+            raise ValueError('worker failed')
+        return explore(self, *args)
+    monkeypatch.setattr(Generator, 'explore', failing)
+    generator = Generator(setupFixture()).parallel(2, frontier=50, remembered=1000, batch=4)
+    with pytest.raises(ShardFailed, match='worker failed'):
+        list(generator)
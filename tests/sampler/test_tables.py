@@ -0,0 +1,119 @@
+import io
+
+from bootstrap.interpreter import buildCommon, stage2
+from bootstrap.sampler import *
+
+seqChoice = '''
+{
+    'seq":  {[NS!'either"]}
+    'either": { [N!'A"] [N!'B"] }
+    'A": {[T!'a"]}
+    'B": {[T!'b"]}
+}
+'''
+
+def setupFixture(source=seqChoice):
+    stage1g, _, stage1 = buildCommon()
+    res = next(stage1.execute(source), None)
+    assert res is not None
+    return stage2(res)
+
+def test_countsMatchRecursive():
+    grammar = setupFixture(open('bootstrap/interpreter/grammar.g').read())
+    recursive, tables = Sampler(grammar), CountTables(grammar, 6)
+    for size in range(7):
+        for name in grammar.rules:
+            assert tables.rule_count(name, size)==recursive.count_rule(name, size, []), (name,size)
+
+def test_seqCounts():
+    tables = CountTables(setupFixture(), 8)
+    assert tables.rules['seq']==[0] + [2**n for n in range(1,9)]
+
+def test_seqSample():
+    s = Sampler(setupFixture(), bottomup=True)
+    for i in range(10):
+        res = s.sample_rule('seq',4)
+        assert len(res)==4
+        assert all(t.string in ('a','b') for t in res)
+
+def test_convolve():
+    a, b = [3, 0, 2**70, 5], [1, 7, 0, 0, 9]
+    naive = [ sum(a[k]*b[n-k] for k in range(n+1) if k<len(a) and n-k<len(b)) for n in range(6) ]
+    assert convolve(a, b, 5)==naive
+    assert convolve([0,0], b, 3)==[0,0,0,0]
+
+def test_cacheBounded():
+    grammar = setupFixture()
+    s = Sampler(grammar, cache=CountCache(grammar, capacity=4))
+    assert s.count_rule('seq', 8, [])==256
+    assert len(s.cache)==4
+    assert [ s.count_rule('seq', 6, [('A',k)]) for k in range(7) ]==[ math.comb(6,k) for k in range(7) ]
+    for sample in s.sample_many('seq', 6, 5, bias=[('A',2)], seed=3):
+        assert [t.string for t in sample].count('a')==2
+    biased = s.bias_tables([('A',2)])
+    assert len(s.biased)<=4  and  len(s.weights)<=4  and  len(s.allocations)<=4
+    assert len(biased.rules)<=4  and  len(biased.prefixes)<=4  and  len(biased.weights)<=4
+
+def test_cacheReuse(tmp_path):
+    grammar = setupFixture()
+    s = Sampler(grammar, bottomup=True, cache=CountCache(grammar, directory=tmp_path))
+    assert s.count_rule('seq', 8, [])==256
+    assert s.count_rule('either', 1, [('A',1)])==1
+    s.save()
+    warm = Sampler(setupFixture(), bottomup=True, cache=CountCache(grammar, directory=tmp_path))
+    assert warm.tables.size==8
+    assert warm.tables.rules['seq']==s.tables.rules['seq']
+    assert ('rule','either',1,(('A',1),)) in warm.cache
+    assert len(warm.sample_rule('seq',6))==6
+
+def test_sampleManySeeded():
+    grammar = setupFixture(open('bootstrap/interpreter/grammar.g').read())
+    for bottomup in (False, True):
+        first  = Sampler(grammar, bottomup=bottomup).sample_many('program', 5, 20, seed=7)
+        second = Sampler(grammar, bottomup=bottomup).sample_many('program', 5, 20, seed=7)
+        assert [list(map(symbol_key,s)) for s in first]==[list(map(symbol_key,s)) for s in second]
+
+def test_parallelIndependentOfWorkers():
+    grammar = setupFixture(open('bootstrap/interpreter/grammar.g').read())
+    single = Sampler(grammar, bottomup=True).sample_parallel('program', 6, 40, seed=5, workers=1, render=True, chunk=7)
+    pooled = Sampler(grammar, bottomup=True).sample_parallel('program', 6, 40, seed=5, workers=3, render=True)
+    assert single==pooled
+    assert len(single)==40
+
+def test_biasCounts():
+    s = Sampler(setupFixture())
+    assert [ s.count_rule('seq', 6, [('A',k)]) for k in range(7) ]==[ math.comb(6,k) for k in range(7) ]
+    assert s.count_rule('seq', 6, [('A',2),('B',3)])==0
+    for sample in s.sample_many('seq', 6, 10, bias=[('A',2)], seed=3):
+        assert [t.string for t in sample].count('a')==2
+
+def test_biasMatchesUnbiased():
+    grammar = setupFixture(open('bootstrap/interpreter/grammar.g').read())
+    tables, biased = CountTables(grammar, 6), BiasTables(grammar, [('statement',10), ('expr',10)])
+    for size in range(7):
+        assert sum(biased.rule_poly('program', size).values())==tables.rule_count('program', size)
+
+def test_enumerateSeq():
+    e = Enumerator(setupFixture())
+    sentences = [ "".join(t.string for t in s) for s in e.produce('seq', 5) ]
+    assert sorted(sentences)==sorted("".join(p) for p in itertools.product('ab', repeat=5))
+
+def test_enumerateResume():
+    e = Enumerator(setupFixture(open('bootstrap/interpreter/grammar.g').read()))
+    full = [ list(map(symbol_key,s)) for s in e.produce('program', 4) ]
+    assert len(full)==e.count('program', 4)
+    cursor = e.produce('program', 4)
+    first = [ list(map(symbol_key,next(cursor))) for i in range(10) ]
+    resumed = e.produce(*cursor.state())
+    assert first + [ list(map(symbol_key,s)) for s in resumed ]==full
+    ranges = e.split('program', 4, 3)
+    assert [ list(map(symbol_key,s)) for lo,hi in ranges for s in e.produce('program', 4, lo, hi) ]==full
+    assert list(map(symbol_key,e.unrank('program', 4, 57)))==full[57]
+
+def test_renderStream():
+    grammar = setupFixture(open('bootstrap/interpreter/grammar.g').read())
+    samples = Sampler(grammar, bottomup=True).sample_many('program', 8, 20, seed=2)
+    out = io.StringIO()
+    renderStream(samples, out, random.Random(5))
+    rng = random.Random(5)
+    assert out.getvalue()=="".join(renderText(s, rng) + "\n" for s in samples)
@@ -0,0 +1,17 @@
+from bootstrap.treegen import *
+
+def maxDegree(node):
+    return max([len(node.children)] + [maxDegree(c) for c in node.children])
+
+def test_countsMatchMemo():
+    ts = TreeSampler(3, 8)
+    for n in range(9):
+        assert ts.count(n)==memo_tree(3, n)
+
+def test_sampleCovers():
+    ts = TreeSampler(3, 5)
+    trees = ts.sample_many(2000, seed=1)
+    assert all(t.size()==6 for t in trees)
+    assert all(maxDegree(t)<=3 for t in trees)
+    assert len(set(str(t) for t in trees))==memo_tree(3, 5)
+    assert [str(t) for t in ts.sample_many(20, seed=4)]==[str(t) for t in ts.sample_many(20, seed=4)]